@@ -49,7 +49,7 @@ def create_app() -> Flask:
     )
     socketio.init_app(app)
     codex_llm.write_codex_config(settings_service.get_settings().config)
-    from .listeners import task_status_listener  # noqa: F401
+    from .listeners import instruction_listener, socket_events, task_status_listener  # noqa: F401
 
     @app.context_processor
     def inject_projects() -> dict[str, list[Project]]:
@@ -3,9 +3,12 @@ from __future__ import annotations
 import os
 
 from . import create_app
+from .scheduler import llm_scheduler
 from .socketio import socketio
 
 app = create_app()
+if llm_scheduler.inline and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    llm_scheduler.start()
 
 if __name__ == "__main__":
     exclude_patterns = [os.path.join(os.getcwd(), "sandbox", "*")]
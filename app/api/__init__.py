@@ -4,4 +4,4 @@ from flask import Blueprint
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
-from . import agents, projects, roles, settings, statuses, tasks  # noqa: E402,F401
+from . import agents, llm, projects, roles, settings, statuses, tasks  # noqa: E402,F401
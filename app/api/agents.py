@@ -47,6 +47,8 @@ def api_create_agent():
         clean_str(data.get("working_status_id")),
         optional_str(data.get("acceptance_criteria")),
         optional_str(data.get("transfer_criteria")),
+        bool(data.get("use_response_cache", True)),
+        clean_str(data.get("max_concurrency", 1)),
     )
     if error:
         return json_error(error, 400)
@@ -113,6 +115,8 @@ def api_update_agent(agent_id: int):
         clean_str(data.get("working_status_id")),
         optional_str(data.get("acceptance_criteria")),
         optional_str(data.get("transfer_criteria")),
+        bool(data.get("use_response_cache", True)),
+        clean_str(data.get("max_concurrency", 1)),
     )
     if error:
         return json_error(error, 400)
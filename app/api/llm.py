@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from flask import jsonify, request
+
+from ..scheduler import llm_scheduler
+from ..services import llm_runs as llm_runs_service
+from . import api_bp
+
+
+@api_bp.get("/llm/queue")
+def api_llm_queue():
+    """Состояние очереди LLM.
+    ---
+    tags:
+      - llm
+    responses:
+      200:
+        description: OK
+    """
+    return jsonify(llm_scheduler.get_stats())
+
+
+@api_bp.get("/metrics/llm")
+def api_llm_metrics():
+    """Метрики запусков LLM: перцентили задержек и расход токенов по агентам, моделям и проектам.
+    ---
+    tags:
+      - llm
+    parameters:
+      - name: hours
+        in: query
+        required: false
+        schema:
+          type: number
+    responses:
+      200:
+        description: OK
+    """
+    hours = request.args.get("hours", type=float)
+    return jsonify(llm_runs_service.get_llm_metrics(hours))
@@ -168,3 +168,27 @@ def api_update_task_status(task_id: int):
     if error:
         return json_error(error, 400)
     return jsonify({"id": task.id, "status_id": task.status_id})
+
+
+@api_bp.post("/tasks/<int:task_id>/llm/cancel")
+def api_cancel_task_llm(task_id: int):
+    """Отменить запуск агента для задачи.
+    ---
+    tags:
+      - tasks
+    parameters:
+      - name: task_id
+        in: path
+        required: true
+        schema:
+          type: integer
+    responses:
+      200:
+        description: OK
+      404:
+        description: Not Found
+    """
+    cancelled, error = tasks_service.cancel_llm_run(task_id)
+    if error:
+        return json_error(error, 404)
+    return jsonify({"task_id": task_id, "cancelled": cancelled})
@@ -56,12 +56,14 @@ def agent_to_dict(agent) -> dict[str, object]:
         "name": agent.name,
         "role_id": agent.role_id,
         "project_id": agent.project_id,
-        "current_task_id": agent.current_task_id,
+        "max_concurrency": agent.max_concurrency,
+        "task_ids": [assignment.task_id for assignment in agent.assignments],
         "success_status_id": agent.success_status_id,
         "error_status_id": agent.error_status_id,
         "working_status_id": agent.working_status_id,
         "acceptance_criteria": agent.acceptance_criteria,
         "transfer_criteria": agent.transfer_criteria,
+        "use_response_cache": agent.use_response_cache,
     }
 
 
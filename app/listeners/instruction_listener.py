@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes
+
+from app.models import Agent, Role, Settings
+from llm.codex import invalidate_codex_instructions
+
+_INSTRUCTION_FIELDS: dict[type, tuple[str, ...]] = {
+    Settings: ("instructions",),
+    Role: ("instruction",),
+    Agent: ("role_id", "acceptance_criteria", "transfer_criteria"),
+}
+
+
+def _changes(session: Session) -> dict[str, object]:
+    return session.info.setdefault(
+        "instruction_changes", {"settings": False, "role_ids": set(), "agent_ids": set()}
+    )
+
+
+def _record(changes: dict[str, object], obj: object) -> None:
+    if isinstance(obj, Settings):
+        changes["settings"] = True
+    elif isinstance(obj, Role) and obj.id is not None:
+        changes["role_ids"].add(obj.id)
+    elif isinstance(obj, Agent) and obj.id is not None:
+        changes["agent_ids"].add(obj.id)
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_instruction_versions(session: Session, flush_context, instances) -> None:
+    for obj in session.dirty:
+        fields = _INSTRUCTION_FIELDS.get(type(obj))
+        if not fields:
+            continue
+        if not any(attributes.get_history(obj, field).has_changes() for field in fields):
+            continue
+        obj.version = (obj.version or 0) + 1
+        _record(_changes(session), obj)
+    for obj in session.deleted:
+        if type(obj) in _INSTRUCTION_FIELDS:
+            _record(_changes(session), obj)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_instructions(session: Session) -> None:
+    changes = session.info.pop("instruction_changes", None)
+    if not changes:
+        return
+    invalidate_codex_instructions(
+        settings_changed=changes["settings"],
+        role_ids=changes["role_ids"],
+        agent_ids=changes["agent_ids"],
+    )
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_instruction_changes(session: Session) -> None:
+    session.info.pop("instruction_changes", None)
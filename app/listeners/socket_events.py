@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+from app.services import tasks as tasks_service
+from app.socketio import socketio
+
+
+@socketio.on("task_llm_cancel")
+def _cancel_task_llm(payload) -> None:
+    task_id = (payload or {}).get("task_id")
+    if task_id is None:
+        return
+    cancelled, error = tasks_service.cancel_llm_run(int(task_id))
+    socketio.emit(
+        "task_llm_cancel_result",
+        {"task_id": int(task_id), "cancelled": cancelled, "error": error},
+    )
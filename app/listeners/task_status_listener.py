@@ -3,7 +3,9 @@ from __future__ import annotations
 from sqlalchemy import event
 from sqlalchemy.orm import Session, attributes
 
-from app.models import Task
+from app.models import AgentAssignment, LlmJob, Task
+from app.scheduler import PRIORITY_AGENT, PRIORITY_MANUAL, llm_scheduler
+from app.services import llm_jobs as llm_jobs_service
 from app.services import tasks as tasks_service
 from app.socketio import socketio
 
@@ -11,31 +13,74 @@ from app.socketio import socketio
 @event.listens_for(Session, "after_flush")
 def _track_task_status_changes(session: Session, flush_context) -> None:
     task_ids = session.info.setdefault("status_change_task_ids", {})
+    agent_ids_by_task: dict[int, int] | None = None
     for obj in session.dirty:
         if not isinstance(obj, Task):
             continue
         history = attributes.get_history(obj, "status_id")
         if history.has_changes() and history.deleted:
             if obj.id is not None:
+                if agent_ids_by_task is None:
+                    agent_ids_by_task = {
+                        assignment.task_id: assignment.agent_id
+                        for assignment in [*session.identity_map.values(), *session.new]
+                        if isinstance(assignment, AgentAssignment)
+                        and assignment not in session.deleted
+                    }
                 new_status_id = history.added[-1] if history.added else obj.status_id
-                task_ids[obj.id] = new_status_id
+                task_ids[obj.id] = (new_status_id, obj.project_id, agent_ids_by_task.get(obj.id))
 
 
 @event.listens_for(Session, "after_commit")
 def _run_task_status_observers(session: Session) -> None:
     task_ids = session.info.pop("status_change_task_ids", {})
+    assigned_task_ids = session.info.pop("assigned_task_ids", {})
+    priority = session.info.get("llm_priority", PRIORITY_MANUAL)
+    for task_id, (status_id, project_id, agent_id) in assigned_task_ids.items():
+        # Задаче отдали место освободившегося агента; ее статус не менялся.
+        if task_id not in task_ids:
+            _submit(task_id, status_id, project_id, agent_id, priority)
     if not task_ids:
         return
-    for task_id, status_id in task_ids.items():
+    staffed_status_ids = llm_jobs_service.get_staffed_status_ids(
+        {status_id for status_id, _, _ in task_ids.values() if status_id is not None}
+    )
+    for task_id, (status_id, project_id, agent_id) in task_ids.items():
         socketio.emit(
             "task_status_changed",
             {"task_id": task_id, "status_id": status_id},
         )
-        socketio.start_background_task(_run_llm_for_task, task_id)
+        if priority != PRIORITY_AGENT:
+            # Задачу передвинули вручную: запуск для прежнего статуса больше не нужен.
+            # Статус меняет и сам агент по завершении — свой запуск он доводит до конца.
+            llm_jobs_service.request_cancel(task_id, include_pending=False)
+            llm_scheduler.cancel(task_id)
+        if status_id not in staffed_status_ids:
+            # В статусе без агентов (например, «Готово») запускать некого.
+            continue
+        _submit(task_id, status_id, project_id, agent_id, priority)
+
+
+def _submit(
+    task_id: int,
+    status_id: int | None,
+    project_id: int | None,
+    agent_id: int | None,
+    priority: int,
+) -> None:
+    if not llm_scheduler.submit(task_id, status_id, project_id, agent_id, priority):
+        print(f"[listener] Очередь LLM переполнена, задача {task_id} не поставлена.")
+        tasks_service.reject_llm_run(
+            task_id, agent_id, "Очередь LLM переполнена, запуск не поставлен. Верните задачу позже."
+        )
+
+
+def _run_llm_for_task(job: LlmJob) -> str | None:
+    queue_wait_sec = None
+    if job.started_at and job.available_at:
+        queue_wait_sec = max(0.0, (job.started_at - job.available_at).total_seconds())
+    _, error = tasks_service.sent_to_llm(job.task_id, job.id, queue_wait_sec)
+    return error
 
 
-def _run_llm_for_task(task_id: int) -> None:
-    try:
-        tasks_service.sent_to_llm(task_id)
-    except Exception as exc:  # pragma: no cover - фоновые ошибки
-        print(f"[listener] Ошибка LLM для задачи {task_id}: {exc}")
+llm_scheduler.init_handler(_run_llm_for_task)
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from sqlalchemy import ForeignKey, Integer, String, Text
+from datetime import datetime
+
+from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Index, Integer, String, Text, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -14,6 +16,7 @@ class Role(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(120), nullable=False, unique=True)
     instruction: Mapped[str | None] = mapped_column(Text, nullable=True)
+    version: Mapped[int] = mapped_column(Integer(), nullable=False, default=1)
     agents: Mapped[list["Agent"]] = relationship(back_populates="role", cascade="all, delete-orphan")
 
 
@@ -24,7 +27,7 @@ class Agent(Base):
     name: Mapped[str] = mapped_column(String(120), nullable=False)
     role_id: Mapped[int] = mapped_column(ForeignKey("roles.id"), nullable=False)
     project_id: Mapped[int | None] = mapped_column(ForeignKey("projects.id"), nullable=True)
-    current_task_id: Mapped[int | None] = mapped_column(ForeignKey("tasks.id"), nullable=True)
+    max_concurrency: Mapped[int] = mapped_column(Integer(), nullable=False, default=1)
     success_status_id: Mapped[int | None] = mapped_column(
         ForeignKey("statuses.id"), nullable=True
     )
@@ -36,9 +39,13 @@ class Agent(Base):
     )
     acceptance_criteria: Mapped[str | None] = mapped_column(Text, nullable=True)
     transfer_criteria: Mapped[str | None] = mapped_column(Text, nullable=True)
+    use_response_cache: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=True)
+    version: Mapped[int] = mapped_column(Integer(), nullable=False, default=1)
     role: Mapped[Role] = relationship(back_populates="agents")
     project: Mapped[Project | None] = relationship(foreign_keys=[project_id])
-    current_task: Mapped[Task | None] = relationship(foreign_keys=[current_task_id])
+    assignments: Mapped[list["AgentAssignment"]] = relationship(
+        back_populates="agent", cascade="all, delete-orphan", order_by="AgentAssignment.id"
+    )
     success_status: Mapped[Status | None] = relationship(foreign_keys=[success_status_id])
     error_status: Mapped[Status | None] = relationship(foreign_keys=[error_status_id])
     working_status: Mapped[Status | None] = relationship(
@@ -94,6 +101,7 @@ class Settings(Base):
     model: Mapped[str] = mapped_column(Text, nullable=False)
     instructions: Mapped[str] = mapped_column(Text, nullable=False)
     config: Mapped[str] = mapped_column(Text, nullable=False)
+    version: Mapped[int] = mapped_column(Integer(), nullable=False, default=1)
 
 
 class Task(Base):
@@ -108,6 +116,26 @@ class Task(Base):
     messages: Mapped[list["Message"]] = relationship(
         back_populates="task", cascade="all, delete-orphan"
     )
+    llm_jobs: Mapped[list["LlmJob"]] = relationship(
+        back_populates="task", cascade="all, delete-orphan"
+    )
+    summary: Mapped["TaskSummary | None"] = relationship(
+        back_populates="task", cascade="all, delete-orphan", uselist=False
+    )
+    assignment: Mapped["AgentAssignment | None"] = relationship(
+        back_populates="task", cascade="all, delete-orphan", uselist=False
+    )
+
+
+class AgentAssignment(Base):
+    __tablename__ = "agent_assignments"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    agent_id: Mapped[int] = mapped_column(ForeignKey("agents.id"), nullable=False, index=True)
+    task_id: Mapped[int] = mapped_column(ForeignKey("tasks.id"), nullable=False, unique=True)
+    assigned_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    agent: Mapped[Agent] = relationship(back_populates="assignments")
+    task: Mapped[Task] = relationship(back_populates="assignment")
 
 
 class Message(Base):
@@ -119,3 +147,89 @@ class Message(Base):
     text: Mapped[str] = mapped_column(Text, nullable=False)
     task: Mapped[Task] = relationship(back_populates="messages")
     author: Mapped[Agent] = relationship(foreign_keys=[author_id])
+
+
+class LlmJob(Base):
+    __tablename__ = "llm_jobs"
+    __table_args__ = (
+        Index("ix_llm_jobs_state_priority", "state", "priority", "id"),
+        # У задачи не больше одного ожидающего задания: на него склеиваются новые триггеры.
+        Index(
+            "uq_llm_jobs_pending_task_id",
+            "task_id",
+            unique=True,
+            sqlite_where=text("state = 'pending'"),
+            postgresql_where=text("state = 'pending'"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    task_id: Mapped[int] = mapped_column(ForeignKey("tasks.id"), nullable=False, index=True)
+    status_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    project_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    agent_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    priority: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    state: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer(), nullable=False, default=1)
+    cancel_requested: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False)
+    lease_owner: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(DateTime(), nullable=True)
+    available_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    started_at: Mapped[datetime | None] = mapped_column(DateTime(), nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(), nullable=True)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    task: Mapped[Task] = relationship(back_populates="llm_jobs")
+
+
+class LlmResponseCacheEntry(Base):
+    __tablename__ = "llm_response_cache"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    key: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+    response: Mapped[str] = mapped_column(Text, nullable=False)
+    hits: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    last_used_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, index=True)
+
+
+class TaskSummary(Base):
+    __tablename__ = "task_summaries"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    task_id: Mapped[int] = mapped_column(ForeignKey("tasks.id"), nullable=False, unique=True)
+    last_message_id: Mapped[int] = mapped_column(Integer(), nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    task: Mapped[Task] = relationship(back_populates="summary")
+
+
+class LlmRun(Base):
+    __tablename__ = "llm_runs"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    task_id: Mapped[int] = mapped_column(Integer(), nullable=False, index=True)
+    job_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    agent_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    project_id: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    model: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    outcome: Mapped[str] = mapped_column(String(20), nullable=False)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    cache_hit: Mapped[bool] = mapped_column(Boolean(), nullable=False, default=False)
+    retries: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    queue_wait_sec: Mapped[float | None] = mapped_column(Float(), nullable=True)
+    mcp_wait_sec: Mapped[float] = mapped_column(Float(), nullable=False, default=0.0)
+    mcp_spawn_sec: Mapped[float] = mapped_column(Float(), nullable=False, default=0.0)
+    latency_sec: Mapped[float] = mapped_column(Float(), nullable=False, default=0.0)
+    model_sec: Mapped[float] = mapped_column(Float(), nullable=False, default=0.0)
+    tool_calls: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    tool_sec: Mapped[float] = mapped_column(Float(), nullable=False, default=0.0)
+    tool_cache_hits: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    tool_cache_misses: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    requests: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    input_tokens: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    output_tokens: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    total_tokens: Mapped[int] = mapped_column(Integer(), nullable=False, default=0)
+    started_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False, index=True)
+    finished_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
@@ -34,6 +34,8 @@ def create_agent() -> str:
     working_status_id = request.form.get("working_status_id", "").strip()
     acceptance_criteria = request.form.get("acceptance_criteria", "").strip() or None
     transfer_criteria = request.form.get("transfer_criteria", "").strip() or None
+    use_response_cache = request.form.get("use_response_cache") == "1"
+    max_concurrency = request.form.get("max_concurrency", "").strip()
 
     agent, error = agents_service.create_agent(
         name,
@@ -44,6 +46,8 @@ def create_agent() -> str:
         working_status_id,
         acceptance_criteria,
         transfer_criteria,
+        use_response_cache,
+        max_concurrency,
     )
     if error:
         roles, projects, statuses, status_agents = agents_service.get_form_data()
@@ -63,6 +67,8 @@ def create_agent() -> str:
             working_status_id=working_status_id,
             acceptance_criteria=acceptance_criteria,
             transfer_criteria=transfer_criteria,
+            use_response_cache=use_response_cache,
+            max_concurrency=max_concurrency,
         )
 
     flash("Агент создан.", "success")
@@ -97,6 +103,8 @@ def update_agent(agent_id: int) -> str:
     working_status_id = request.form.get("working_status_id", "").strip()
     acceptance_criteria = request.form.get("acceptance_criteria", "").strip() or None
     transfer_criteria = request.form.get("transfer_criteria", "").strip() or None
+    use_response_cache = request.form.get("use_response_cache") == "1"
+    max_concurrency = request.form.get("max_concurrency", "").strip()
 
     agent, error = agents_service.update_agent(
         agent_id,
@@ -108,6 +116,8 @@ def update_agent(agent_id: int) -> str:
         working_status_id,
         acceptance_criteria,
         transfer_criteria,
+        use_response_cache,
+        max_concurrency,
     )
     if error:
         roles, projects, statuses, status_agents = agents_service.get_form_data()
@@ -128,6 +138,8 @@ def update_agent(agent_id: int) -> str:
             working_status_id=working_status_id,
             acceptance_criteria=acceptance_criteria,
             transfer_criteria=transfer_criteria,
+            use_response_cache=use_response_cache,
+            max_concurrency=max_concurrency,
         )
 
     flash("Агент обновлен.", "success")
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from typing import Callable
+
+from llm.codex import cancel_task_run
+from llm.resilience import CircuitOpenError
+from .models import LlmJob
+from .services import llm_jobs as llm_jobs_service
+
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "4"))
+LLM_MAX_PER_PROJECT = int(os.getenv("LLM_MAX_PER_PROJECT", "0"))
+LLM_MAX_PER_AGENT = int(os.getenv("LLM_MAX_PER_AGENT", "0"))
+LLM_POLL_SEC = float(os.getenv("LLM_POLL_SEC", "2"))
+LLM_INLINE_WORKERS = os.getenv("LLM_INLINE_WORKERS", "1") == "1"
+LLM_CANCEL_POLL_SEC = float(os.getenv("LLM_CANCEL_POLL_SEC", "1"))
+
+PRIORITY_AGENT = 0
+PRIORITY_MANUAL = 10
+
+
+class LlmScheduler:
+    def __init__(
+        self,
+        workers: int = LLM_WORKERS,
+        max_per_project: int = LLM_MAX_PER_PROJECT,
+        max_per_agent: int = LLM_MAX_PER_AGENT,
+        inline: bool = LLM_INLINE_WORKERS,
+    ) -> None:
+        self.workers = max(1, workers)
+        self.inline = inline
+        self.max_per_project = max_per_project
+        self.max_per_agent = max_per_agent
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._handler: Callable[[LlmJob], str | None] | None = None
+        self._condition = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._running_jobs: dict[int, int] = {}
+        self._rejected = 0
+
+    def init_handler(self, handler: Callable[[LlmJob], str | None]) -> None:
+        self._handler = handler
+
+    def start(self) -> None:
+        with self._condition:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                self._threads.append(
+                    threading.Thread(target=self._work, name=f"llm-worker-{index + 1}", daemon=True)
+                )
+            self._threads.append(
+                threading.Thread(target=self._heartbeat, name="llm-heartbeat", daemon=True)
+            )
+            for thread in self._threads:
+                thread.start()
+
+    def submit(
+        self,
+        task_id: int,
+        status_id: int | None = None,
+        project_id: int | None = None,
+        agent_id: int | None = None,
+        priority: int = PRIORITY_MANUAL,
+    ) -> bool:
+        job = llm_jobs_service.enqueue_job(task_id, status_id, project_id, agent_id, priority)
+        if self.inline:
+            self.start()
+        with self._condition:
+            if job is None:
+                self._rejected += 1
+                return False
+            self._condition.notify()
+        return True
+
+    def get_stats(self) -> dict[str, object]:
+        stats = llm_jobs_service.get_queue_stats()
+        with self._condition:
+            stats.update(
+                {
+                    "workers": self.workers if self._threads else 0,
+                    "worker_id": self.worker_id,
+                    "running_local": len(self._running_jobs),
+                    "rejected": self._rejected,
+                }
+            )
+        return stats
+
+    def _claim(self):
+        try:
+            return llm_jobs_service.claim_job(
+                self.worker_id, self.max_per_project, self.max_per_agent
+            )
+        except Exception as exc:  # pragma: no cover - ошибки БД
+            print(f"[scheduler] Не удалось получить задание: {exc}")
+            return None
+
+    def _work(self) -> None:
+        while True:
+            job = self._claim()
+            if job is None:
+                with self._condition:
+                    self._condition.wait(LLM_POLL_SEC)
+                continue
+
+            with self._condition:
+                self._running_jobs[job.id] = job.task_id
+            try:
+                error = self._handler(job) if self._handler is not None else None
+            except CircuitOpenError as exc:
+                # Задание ждет закрытия предохранителя, а не уходит в статус ошибки.
+                llm_jobs_service.retry_job(
+                    job.id, self.worker_id, str(exc), hold_sec=exc.retry_after_sec
+                )
+            except Exception as exc:
+                print(f"[scheduler] Ошибка LLM для задачи {job.task_id}: {exc}")
+                llm_jobs_service.retry_job(job.id, self.worker_id, str(exc))
+            else:
+                llm_jobs_service.finish_job(job.id, self.worker_id, error)
+            finally:
+                with self._condition:
+                    self._running_jobs.pop(job.id, None)
+                    self._condition.notify_all()
+
+    def cancel(self, task_id: int) -> bool:
+        with self._condition:
+            is_local = task_id in self._running_jobs.values()
+        return is_local and cancel_task_run(task_id)
+
+    def _heartbeat(self) -> None:
+        interval = max(1.0, llm_jobs_service.LLM_JOB_LEASE_SEC / 3)
+        renewed_at = time.monotonic()
+        while True:
+            time.sleep(LLM_CANCEL_POLL_SEC)
+            with self._condition:
+                running = dict(self._running_jobs)
+            try:
+                for job_id in llm_jobs_service.get_cancel_requested(list(running)):
+                    cancel_task_run(running[job_id])
+                if time.monotonic() - renewed_at >= interval:
+                    renewed_at = time.monotonic()
+                    llm_jobs_service.renew_leases(self.worker_id, list(running))
+            except Exception as exc:  # pragma: no cover - ошибки БД
+                print(f"[scheduler] Не удалось обслужить выполняемые задания: {exc}")
+
+
+llm_scheduler = LlmScheduler()
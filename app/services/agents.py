@@ -7,8 +7,9 @@ from sqlalchemy.orm import selectinload
 
 from ..db import SessionLocal
 from llm.codex import register_codex_agent, remove_codex_agent
-from ..models import Agent, Project, Role, Status
+from ..models import Agent, AgentAssignment, Project, Role, Status
 from ..services import settings as settings_service
+from ..services import tasks as tasks_service
 
 
 def list_agents() -> list[Agent]:
@@ -19,7 +20,7 @@ def list_agents() -> list[Agent]:
             .options(
                 selectinload(Agent.role),
                 selectinload(Agent.project),
-                selectinload(Agent.current_task),
+                selectinload(Agent.assignments).selectinload(AgentAssignment.task),
                 selectinload(Agent.success_status),
                 selectinload(Agent.error_status),
                 selectinload(Agent.working_status),
@@ -53,6 +54,14 @@ def get_form_data() -> tuple[list[Role], list[Project], list[Status], dict[int,
     return roles, projects, statuses, status_agents
 
 
+def _parse_max_concurrency(value: str) -> int | None:
+    try:
+        replicas = int(value or "1")
+    except ValueError:
+        return None
+    return replicas if replicas >= 1 else None
+
+
 def create_agent(
     name: str,
     role_id: str,
@@ -62,6 +71,8 @@ def create_agent(
     working_status_id: str,
     acceptance_criteria: str | None,
     transfer_criteria: str | None,
+    use_response_cache: bool = True,
+    max_concurrency: str = "1",
 ) -> tuple[Agent | None, str | None]:
     if (
         not name
@@ -73,6 +84,10 @@ def create_agent(
     ):
         return None, "Имя, роль, проект и статусы обязательны."
 
+    replicas = _parse_max_concurrency(max_concurrency)
+    if replicas is None:
+        return None, "Число параллельных задач должно быть целым числом от 1."
+
     session = SessionLocal()
     role = session.get(Role, int(role_id))
     if not role:
@@ -104,11 +119,16 @@ def create_agent(
         working_status_id=working_status.id,
         acceptance_criteria=acceptance_criteria,
         transfer_criteria=transfer_criteria,
+        use_response_cache=use_response_cache,
+        max_concurrency=replicas,
     )
     session.add(agent)
+    session.flush()
+    # Задачи, которые уже ждут агента в рабочем статусе, сразу получают новые места.
+    tasks_service.assign_waiting_tasks(session, agent.working_status_id, agent.max_concurrency)
     session.commit()
     settings = settings_service.get_settings()
-    register_codex_agent(agent, settings.api_key, settings.model)
+    register_codex_agent(agent, settings.api_key, settings.model, settings)
     return agent, None
 
 
@@ -122,6 +142,8 @@ def update_agent(
     working_status_id: str,
     acceptance_criteria: str | None,
     transfer_criteria: str | None,
+    use_response_cache: bool = True,
+    max_concurrency: str = "1",
 ) -> tuple[Agent | None, str | None]:
     session = SessionLocal()
     agent = session.get(Agent, agent_id)
@@ -138,6 +160,10 @@ def update_agent(
     ):
         return None, "Имя, роль, проект и статусы обязательны."
 
+    replicas = _parse_max_concurrency(max_concurrency)
+    if replicas is None:
+        return None, "Число параллельных задач должно быть целым числом от 1."
+
     role = session.get(Role, int(role_id))
     if not role:
         return None, "Роль не найдена."
@@ -168,11 +194,20 @@ def update_agent(
     agent.working_status_id = working_status.id
     agent.acceptance_criteria = acceptance_criteria
     agent.transfer_criteria = transfer_criteria
-    if agent.current_task_id and previous_working_status_id != working_status.id:
-        agent.current_task_id = None
+    agent.use_response_cache = use_response_cache
+    agent.max_concurrency = replicas
+    released = 0
+    if previous_working_status_id != working_status.id:
+        released = len(agent.assignments)
+        agent.assignments.clear()
+    session.flush()
+    # Освободившиеся и добавленные места сразу занимают задачи, ждущие агента.
+    if released and previous_working_status_id is not None:
+        tasks_service.assign_waiting_tasks(session, previous_working_status_id, released)
+    tasks_service.assign_waiting_tasks(session, agent.working_status_id, agent.max_concurrency)
     session.commit()
     settings = settings_service.get_settings()
-    register_codex_agent(agent, settings.api_key, settings.model)
+    register_codex_agent(agent, settings.api_key, settings.model, settings)
     return agent, None
 
 
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+from collections import Counter
+
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 
 from ..db import SessionLocal
-from ..models import Agent, Column, Project, Status, Task
+from ..models import Agent, AgentAssignment, Column, Project, Status, Task
 
 
 def get_home_context(project_id: int | None) -> dict[str, object]:
@@ -30,7 +32,14 @@ def get_home_context(project_id: int | None) -> dict[str, object]:
         project = session.get(Project, project_id)
         current_project_name = project.name if project else None
 
-    task_query = select(Task).options(selectinload(Task.messages)).order_by(Task.id)
+    task_query = (
+        select(Task)
+        .options(
+            selectinload(Task.messages),
+            selectinload(Task.assignment).selectinload(AgentAssignment.agent),
+        )
+        .order_by(Task.id)
+    )
     if project_id:
         task_query = task_query.where(Task.project_id == project_id)
     tasks = session.execute(task_query).scalars().all()
@@ -44,13 +53,14 @@ def get_home_context(project_id: int | None) -> dict[str, object]:
             continue
         agents = sorted(status.working_agents, key=lambda agent: agent.name.lower())
         status_tasks = [task for task in tasks if task.status_id == status.id]
-        assigned: list[tuple[Task, Agent | None]] = []
-        free_agents = agents.copy()
-        for task in status_tasks:
-            agent = free_agents.pop(0) if free_agents else None
-            assigned.append((task, agent))
+        assigned: list[tuple[Task, Agent | None]] = [
+            (task, task.assignment.agent if task.assignment else None) for task in status_tasks
+        ]
+        load = Counter(agent.id for _, agent in assigned if agent)
         tasks_by_status[status.id] = assigned
-        free_agents_by_status[status.id] = free_agents
+        free_agents_by_status[status.id] = [
+            agent for agent in agents if load[agent.id] < agent.max_concurrency
+        ]
         statuses_by_project.setdefault(status.project_id, []).append(status)
 
     return {
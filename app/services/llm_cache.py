@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+import os
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import IntegrityError
+
+from ..db import SessionLocal
+from ..models import Agent, LlmResponseCacheEntry
+
+LLM_RESPONSE_CACHE = os.getenv("LLM_RESPONSE_CACHE", "0") == "1"
+LLM_RESPONSE_CACHE_TTL_SEC = float(os.getenv("LLM_RESPONSE_CACHE_TTL_SEC", "86400"))
+LLM_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("LLM_RESPONSE_CACHE_MAX_ENTRIES", "500"))
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class LlmResponseCache:
+    def __init__(
+        self,
+        ttl_sec: float = LLM_RESPONSE_CACHE_TTL_SEC,
+        max_entries: int = LLM_RESPONSE_CACHE_MAX_ENTRIES,
+    ) -> None:
+        self.ttl_sec = ttl_sec
+        self.max_entries = max(1, max_entries)
+
+    def get(self, key: str) -> str | None:
+        session = SessionLocal.session_factory()
+        try:
+            entry = session.execute(
+                select(LlmResponseCacheEntry).where(LlmResponseCacheEntry.key == key)
+            ).scalar_one_or_none()
+            if entry is None:
+                return None
+            now = _utcnow()
+            if self.ttl_sec and entry.created_at < now - timedelta(seconds=self.ttl_sec):
+                session.delete(entry)
+                session.commit()
+                return None
+            entry.hits += 1
+            entry.last_used_at = now
+            response = entry.response
+            session.commit()
+            return response
+        finally:
+            session.close()
+
+    def set(self, key: str, response: str) -> None:
+        session = SessionLocal.session_factory()
+        try:
+            now = _utcnow()
+            entry = session.execute(
+                select(LlmResponseCacheEntry).where(LlmResponseCacheEntry.key == key)
+            ).scalar_one_or_none()
+            if entry is None:
+                session.add(
+                    LlmResponseCacheEntry(
+                        key=key, response=response, hits=0, created_at=now, last_used_at=now
+                    )
+                )
+            else:
+                entry.response = response
+                entry.created_at = now
+                entry.last_used_at = now
+            session.flush()
+            self._evict(session, now)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+        finally:
+            session.close()
+
+    def _evict(self, session, now: datetime) -> None:
+        if self.ttl_sec:
+            session.execute(
+                delete(LlmResponseCacheEntry).where(
+                    LlmResponseCacheEntry.created_at < now - timedelta(seconds=self.ttl_sec)
+                )
+            )
+        count = session.execute(select(func.count(LlmResponseCacheEntry.id))).scalar_one()
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        stale_ids = (
+            session.execute(
+                select(LlmResponseCacheEntry.id)
+                .order_by(LlmResponseCacheEntry.last_used_at, LlmResponseCacheEntry.id)
+                .limit(overflow)
+            )
+            .scalars()
+            .all()
+        )
+        session.execute(
+            delete(LlmResponseCacheEntry).where(LlmResponseCacheEntry.id.in_(stale_ids))
+        )
+
+
+_CACHE = LlmResponseCache()
+
+
+def get_response_cache(agent: Agent) -> LlmResponseCache | None:
+    if not LLM_RESPONSE_CACHE or not agent.use_response_cache:
+        return None
+    return _CACHE
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+import os
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from ..db import SessionLocal
+from ..models import Message, Task, TaskSummary
+
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "4000"))
+LLM_SUMMARY_TOKENS = int(os.getenv("LLM_SUMMARY_TOKENS", "800"))
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "3"))
+
+_SUMMARY_LINE_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / LLM_CHARS_PER_TOKEN) + 1
+
+
+def _author_name(message: Message) -> str:
+    return message.author.name if message.author else f"#{message.author_id}"
+
+
+def _format_message(message: Message) -> str:
+    return f"[{_author_name(message)}]: {message.text.strip()}"
+
+
+def _summarize_message(message: Message) -> str:
+    text = " ".join(message.text.split())
+    if len(text) > _SUMMARY_LINE_CHARS:
+        text = text[: _SUMMARY_LINE_CHARS - 1].rstrip() + "…"
+    return f"- {_author_name(message)}: {text}"
+
+
+def _trim_summary(lines: list[str]) -> list[str]:
+    total = sum(estimate_tokens(line) for line in lines)
+    start = 0
+    while total > LLM_SUMMARY_TOKENS and start < len(lines) - 1:
+        total -= estimate_tokens(lines[start])
+        start += 1
+    return lines[start:]
+
+
+def _select_recent(history: list[Message], budget: int) -> list[Message]:
+    costs = [estimate_tokens(_format_message(message)) for message in history]
+    if sum(costs) <= budget:
+        return history
+    budget -= LLM_SUMMARY_TOKENS
+    count = 0
+    for cost in reversed(costs):
+        if cost > budget:
+            break
+        budget -= cost
+        count += 1
+    return history[len(history) - count :]
+
+
+def _update_summary(session, task_id: int, older: list[Message]) -> str:
+    if not older:
+        return ""
+    summary = session.execute(
+        select(TaskSummary).where(TaskSummary.task_id == task_id)
+    ).scalar_one_or_none()
+    covered_id = summary.last_message_id if summary else 0
+    fresh = [message for message in older if message.id > covered_id]
+    if not fresh:
+        return summary.text
+
+    lines = summary.text.splitlines() if summary else []
+    lines.extend(_summarize_message(message) for message in fresh)
+    text = "\n".join(_trim_summary(lines))
+    if summary is None:
+        summary = TaskSummary(task_id=task_id)
+        session.add(summary)
+    summary.last_message_id = fresh[-1].id
+    summary.text = text
+    summary.updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+    return text
+
+
+def build_task_prompt(task_id: int) -> str | None:
+    session = SessionLocal.session_factory()
+    try:
+        task = session.get(Task, task_id)
+        if not task:
+            return None
+        messages = (
+            session.execute(
+                select(Message)
+                .options(selectinload(Message.author))
+                .where(Message.task_id == task_id)
+                .order_by(Message.id)
+            )
+            .scalars()
+            .all()
+        )
+        if not messages:
+            return None
+        current = messages[-1]
+        history = messages[:-1]
+        if not history:
+            return current.text
+
+        recent = _select_recent(history, LLM_CONTEXT_TOKENS - estimate_tokens(current.text))
+        summary = _update_summary(session, task_id, history[: len(history) - len(recent)])
+
+        parts = [f"Задача #{task.id}: {task.title}"]
+        if summary:
+            parts.append(f"Краткое изложение ранних сообщений:\n{summary}")
+        if recent:
+            history_text = "\n\n".join(_format_message(message) for message in recent)
+            parts.append(f"Предыдущие сообщения:\n{history_text}")
+        parts.append(f"Текущее сообщение:\n{current.text}")
+        return "\n\n".join(parts)
+    finally:
+        session.close()
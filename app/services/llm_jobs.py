@@ -0,0 +1,449 @@
+from __future__ import annotations
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import os
+
+from sqlalchemy import case, exists, func, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from ..db import SessionLocal
+from ..models import Agent, AgentAssignment, LlmJob, Task
+
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "1000"))
+LLM_JOB_LEASE_SEC = float(os.getenv("LLM_JOB_LEASE_SEC", "60"))
+LLM_JOB_MAX_ATTEMPTS = int(os.getenv("LLM_JOB_MAX_ATTEMPTS", "3"))
+LLM_JOB_RETRY_DELAY_SEC = float(os.getenv("LLM_JOB_RETRY_DELAY_SEC", "10"))
+LLM_JOB_CLAIM_BATCH = int(os.getenv("LLM_JOB_CLAIM_BATCH", "50"))
+LLM_DEBOUNCE_SEC = float(os.getenv("LLM_DEBOUNCE_SEC", "1.5"))
+# Ключ advisory-блокировки Postgres, под которой воркеры по очереди забирают задания.
+_CLAIM_LOCK_KEY = 0x6B62_6C6C
+
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_SUCCEEDED = "succeeded"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_job(
+    task_id: int,
+    status_id: int | None,
+    project_id: int | None,
+    agent_id: int | None,
+    priority: int,
+) -> LlmJob | None:
+    session = SessionLocal.session_factory()
+    try:
+        # Ожидающее задание задачи уникально (частичный индекс), поэтому гонка двух
+        # enqueue заканчивается IntegrityError или пустым UPDATE — тогда пробуем снова.
+        for _ in range(3):
+            now = _utcnow()
+            available_at = now + timedelta(seconds=LLM_DEBOUNCE_SEC)
+            pending_id = session.execute(
+                select(LlmJob.id).where(LlmJob.task_id == task_id, LlmJob.state == STATE_PENDING)
+            ).scalar()
+            if pending_id is not None:
+                result = session.execute(
+                    update(LlmJob)
+                    .where(LlmJob.id == pending_id, LlmJob.state == STATE_PENDING)
+                    .values(
+                        status_id=status_id,
+                        project_id=project_id,
+                        agent_id=agent_id,
+                        priority=case((LlmJob.priority > priority, priority), else_=LlmJob.priority),
+                        available_at=case(
+                            (LlmJob.available_at < available_at, available_at),
+                            else_=LlmJob.available_at,
+                        ),
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount != 1:
+                    session.rollback()
+                    continue
+                session.commit()
+                job = session.get(LlmJob, pending_id)
+            else:
+                if LLM_QUEUE_MAX:
+                    depth = session.execute(
+                        select(func.count(LlmJob.id)).where(LlmJob.state == STATE_PENDING)
+                    ).scalar_one()
+                    if depth >= LLM_QUEUE_MAX:
+                        return None
+                job = LlmJob(
+                    task_id=task_id,
+                    status_id=status_id,
+                    project_id=project_id,
+                    agent_id=agent_id,
+                    priority=priority,
+                    state=STATE_PENDING,
+                    attempts=0,
+                    max_attempts=LLM_JOB_MAX_ATTEMPTS,
+                    available_at=available_at,
+                    created_at=now,
+                )
+                session.add(job)
+                try:
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    continue
+                session.refresh(job)
+            session.expunge(job)
+            return job
+        return None
+    finally:
+        session.close()
+
+
+def get_staffed_status_ids(status_ids: set[int]) -> set[int]:
+    """Статусы, в которых работает хотя бы один агент: только для них есть смысл ставить запуск."""
+    if not status_ids:
+        return set()
+    session = SessionLocal.session_factory()
+    try:
+        return set(
+            session.execute(
+                select(Agent.working_status_id)
+                .where(Agent.working_status_id.in_(status_ids))
+                .distinct()
+            ).scalars()
+        )
+    finally:
+        session.close()
+
+
+def _expire_leases(session, now: datetime) -> None:
+    session.execute(
+        update(LlmJob)
+        .where(
+            LlmJob.state == STATE_RUNNING,
+            LlmJob.lease_expires_at < now,
+            LlmJob.cancel_requested.is_(True),
+        )
+        .values(state=STATE_CANCELLED, finished_at=now, lease_owner=None)
+    )
+    session.execute(
+        update(LlmJob)
+        .where(
+            LlmJob.state == STATE_RUNNING,
+            LlmJob.lease_expires_at < now,
+            LlmJob.attempts >= LlmJob.max_attempts,
+        )
+        .values(
+            state=STATE_FAILED,
+            finished_at=now,
+            lease_owner=None,
+            error="Истек срок аренды задания, попытки исчерпаны.",
+        )
+    )
+    session.execute(
+        update(LlmJob)
+        .where(LlmJob.state == STATE_RUNNING, LlmJob.lease_expires_at < now)
+        .values(state=STATE_PENDING, lease_owner=None, lease_expires_at=None, available_at=now)
+    )
+
+
+def claim_job(
+    worker_id: str,
+    max_per_project: int = 0,
+    max_per_agent: int = 0,
+) -> LlmJob | None:
+    session = SessionLocal.session_factory()
+    try:
+        is_postgres = session.get_bind().dialect.name == "postgresql"
+        if is_postgres:
+            # Без блокировки два воркера сверяют лимиты по одному снимку и оба
+            # забирают задание сверх лимита; в SQLite запись и так последовательна.
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _CLAIM_LOCK_KEY})
+        now = _utcnow()
+        _expire_leases(session, now)
+
+        running = session.execute(
+            select(LlmJob.task_id, LlmJob.project_id, LlmJob.agent_id).where(
+                LlmJob.state == STATE_RUNNING
+            )
+        ).all()
+        running_task_ids = {row.task_id for row in running}
+        running_by_project = Counter(row.project_id for row in running if row.project_id)
+        running_by_agent = Counter(row.agent_id for row in running if row.agent_id)
+
+        # Задания задач без назначенного агента ждут в очереди, пока агент не освободится,
+        # и идут после остальных, чтобы не занимать окно выборки.
+        query = (
+            select(LlmJob, AgentAssignment.agent_id)
+            .outerjoin(AgentAssignment, AgentAssignment.task_id == LlmJob.task_id)
+            .where(LlmJob.state == STATE_PENDING, LlmJob.available_at <= now)
+            .order_by(AgentAssignment.id.is_(None), LlmJob.priority, LlmJob.id)
+            .limit(LLM_JOB_CLAIM_BATCH)
+        )
+        if is_postgres:
+            query = query.with_for_update(of=LlmJob, skip_locked=True)
+        rows = session.execute(query).all()
+        candidates = [job for job, _ in rows]
+        assigned_agent_ids = {job.id: agent_id for job, agent_id in rows}
+        candidate_task_ids = {job.task_id for job in candidates}
+        task_statuses = dict(
+            session.execute(
+                select(Task.id, Task.status_id).where(Task.id.in_(candidate_task_ids))
+            ).all()
+        )
+        agent_limits = dict(
+            session.execute(
+                select(Agent.id, Agent.max_concurrency).where(
+                    Agent.id.in_({agent_id for agent_id in assigned_agent_ids.values() if agent_id})
+                )
+            ).all()
+        )
+
+        other = aliased(LlmJob)
+        for job in candidates:
+            if job.status_id is not None and task_statuses.get(job.task_id) != job.status_id:
+                _cancel_stale_job(session, job, now)
+                continue
+            agent_id = assigned_agent_ids[job.id]
+            if agent_id is None or job.task_id in running_task_ids:
+                continue
+            if max_per_project and job.project_id and running_by_project[job.project_id] >= max_per_project:
+                continue
+            agent_limit = agent_limits.get(agent_id, 1)
+            if max_per_agent:
+                agent_limit = min(agent_limit, max_per_agent)
+            if running_by_agent[agent_id] >= agent_limit:
+                continue
+            # Лимиты проверяются еще раз в самом UPDATE, чтобы не полагаться на
+            # прочитанные выше счетчики, если другой воркер успел забрать задание.
+            conditions = [
+                LlmJob.id == job.id,
+                LlmJob.state == STATE_PENDING,
+                ~exists().where(other.state == STATE_RUNNING, other.task_id == job.task_id),
+                _running_count(other, other.agent_id == agent_id) < agent_limit,
+            ]
+            if max_per_project and job.project_id:
+                conditions.append(
+                    _running_count(other, other.project_id == job.project_id) < max_per_project
+                )
+            result = session.execute(
+                update(LlmJob)
+                .where(*conditions)
+                .values(
+                    state=STATE_RUNNING,
+                    agent_id=agent_id,
+                    lease_owner=worker_id,
+                    lease_expires_at=now + timedelta(seconds=LLM_JOB_LEASE_SEC),
+                    attempts=LlmJob.attempts + 1,
+                    started_at=now,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                continue
+            session.commit()
+            session.refresh(job)
+            session.expunge(job)
+            return job
+
+        session.commit()
+        return None
+    finally:
+        session.close()
+
+
+def _running_count(running, *criteria):
+    return (
+        select(func.count(running.id))
+        .where(running.state == STATE_RUNNING, *criteria)
+        .scalar_subquery()
+    )
+
+
+def _cancel_stale_job(session, job: LlmJob, now: datetime) -> None:
+    session.execute(
+        update(LlmJob)
+        .where(LlmJob.id == job.id, LlmJob.state == STATE_PENDING)
+        .values(
+            state=STATE_CANCELLED,
+            finished_at=now,
+            error="Задача перемещена до запуска.",
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def renew_leases(worker_id: str, job_ids: list[int]) -> None:
+    if not job_ids:
+        return
+    session = SessionLocal.session_factory()
+    try:
+        session.execute(
+            update(LlmJob)
+            .where(
+                LlmJob.id.in_(job_ids),
+                LlmJob.lease_owner == worker_id,
+                LlmJob.state == STATE_RUNNING,
+            )
+            .values(lease_expires_at=_utcnow() + timedelta(seconds=LLM_JOB_LEASE_SEC))
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def finish_job(job_id: int, worker_id: str, error: str | None = None) -> None:
+    session = SessionLocal.session_factory()
+    try:
+        session.execute(
+            update(LlmJob)
+            .where(LlmJob.id == job_id, LlmJob.lease_owner == worker_id)
+            .values(
+                state=case(
+                    (LlmJob.cancel_requested.is_(True), STATE_CANCELLED),
+                    else_=STATE_FAILED if error else STATE_SUCCEEDED,
+                ),
+                finished_at=_utcnow(),
+                lease_owner=None,
+                lease_expires_at=None,
+                error=error,
+            )
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def retry_job(
+    job_id: int,
+    worker_id: str,
+    error: str,
+    hold_sec: float | None = None,
+) -> None:
+    """Возвращает задание в очередь; hold_sec — отложить без траты попытки (провайдер недоступен)."""
+    session = SessionLocal.session_factory()
+    try:
+        job = session.get(LlmJob, job_id)
+        if not job or job.lease_owner != worker_id:
+            return
+        now = _utcnow()
+        job.lease_owner = None
+        job.lease_expires_at = None
+        job.error = error
+        if job.cancel_requested:
+            job.state = STATE_CANCELLED
+            job.finished_at = now
+        elif hold_sec is not None:
+            job.state = STATE_PENDING
+            job.attempts = max(0, job.attempts - 1)
+            job.available_at = now + timedelta(seconds=hold_sec)
+        elif job.attempts >= job.max_attempts:
+            job.state = STATE_FAILED
+            job.finished_at = now
+        else:
+            job.state = STATE_PENDING
+            job.available_at = now + timedelta(seconds=LLM_JOB_RETRY_DELAY_SEC * job.attempts)
+        session.commit()
+    finally:
+        session.close()
+
+
+def request_cancel(task_id: int, include_pending: bool = True) -> bool:
+    """Отменяет ожидающие задания задачи и просит воркеры прервать выполняемые.
+
+    С include_pending=False трогает только выполняемые задания — так смена
+    статуса прерывает устаревший запуск, не задевая уже поставленный новый.
+    """
+    session = SessionLocal.session_factory()
+    try:
+        cancelled = 0
+        if include_pending:
+            cancelled += session.execute(
+                update(LlmJob)
+                .where(LlmJob.task_id == task_id, LlmJob.state == STATE_PENDING)
+                .values(
+                    state=STATE_CANCELLED,
+                    cancel_requested=True,
+                    finished_at=_utcnow(),
+                    error="Запуск отменен.",
+                )
+            ).rowcount
+        cancelled += session.execute(
+            update(LlmJob)
+            .where(LlmJob.task_id == task_id, LlmJob.state == STATE_RUNNING)
+            .values(cancel_requested=True)
+        ).rowcount
+        session.commit()
+        return bool(cancelled)
+    finally:
+        session.close()
+
+
+def get_cancel_requested(job_ids: list[int]) -> list[int]:
+    if not job_ids:
+        return []
+    session = SessionLocal.session_factory()
+    try:
+        return list(
+            session.execute(
+                select(LlmJob.id).where(
+                    LlmJob.id.in_(job_ids),
+                    LlmJob.state == STATE_RUNNING,
+                    LlmJob.cancel_requested.is_(True),
+                )
+            ).scalars()
+        )
+    finally:
+        session.close()
+
+
+def get_running_task_ids() -> set[int]:
+    session = SessionLocal()
+    rows = session.execute(
+        select(LlmJob.task_id).where(LlmJob.state == STATE_RUNNING)
+    ).scalars()
+    return set(rows)
+
+
+def get_queue_stats() -> dict[str, object]:
+    session = SessionLocal()
+    now = _utcnow()
+    counts = dict(
+        session.execute(select(LlmJob.state, func.count(LlmJob.id)).group_by(LlmJob.state)).all()
+    )
+    oldest_pending = session.execute(
+        select(func.min(LlmJob.created_at)).where(LlmJob.state == STATE_PENDING)
+    ).scalar_one()
+    recent = session.execute(
+        select(LlmJob.created_at, LlmJob.started_at)
+        .where(LlmJob.started_at.is_not(None))
+        .order_by(LlmJob.started_at.desc())
+        .limit(200)
+    ).all()
+    waits = sorted((row.started_at - row.created_at).total_seconds() for row in recent)
+    running = session.execute(
+        select(LlmJob.project_id, LlmJob.agent_id).where(LlmJob.state == STATE_RUNNING)
+    ).all()
+    return {
+        "queue_depth": counts.get(STATE_PENDING, 0),
+        "queue_max": LLM_QUEUE_MAX,
+        "running": counts.get(STATE_RUNNING, 0),
+        "succeeded": counts.get(STATE_SUCCEEDED, 0),
+        "failed": counts.get(STATE_FAILED, 0),
+        "cancelled": counts.get(STATE_CANCELLED, 0),
+        "oldest_wait_sec": round((now - oldest_pending).total_seconds(), 3) if oldest_pending else 0.0,
+        "avg_wait_sec": round(sum(waits) / len(waits), 3) if waits else 0.0,
+        "p95_wait_sec": round(percentile(waits, 0.95), 3),
+        "running_by_project": dict(Counter(row.project_id for row in running if row.project_id)),
+        "running_by_agent": dict(Counter(row.agent_id for row in running if row.agent_id)),
+    }
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(ratio * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+import os
+
+from sqlalchemy import select
+
+from llm.telemetry import RunStats
+from ..db import SessionLocal
+from ..models import LlmRun
+from .llm_jobs import percentile
+
+LLM_METRICS_WINDOW_HOURS = float(os.getenv("LLM_METRICS_WINDOW_HOURS", "24"))
+LLM_METRICS_MAX_RUNS = int(os.getenv("LLM_METRICS_MAX_RUNS", "5000"))
+
+OUTCOME_SUCCEEDED = "succeeded"
+OUTCOME_AGENT_ERROR = "agent_error"
+OUTCOME_FAILED = "failed"
+OUTCOME_CANCELLED = "cancelled"
+OUTCOME_DISCARDED = "discarded"
+
+_PERCENTILE_FIELDS = (
+    "latency_sec",
+    "queue_wait_sec",
+    "mcp_wait_sec",
+    "model_sec",
+    "tool_sec",
+    "total_tokens",
+)
+_SUM_FIELDS = (
+    "retries",
+    "tool_calls",
+    "tool_cache_hits",
+    "tool_cache_misses",
+    "requests",
+    "input_tokens",
+    "output_tokens",
+    "total_tokens",
+)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def record_run(
+    *,
+    task_id: int,
+    job_id: int | None,
+    agent_id: int | None,
+    project_id: int | None,
+    model: str | None,
+    outcome: str,
+    error: str | None,
+    queue_wait_sec: float | None,
+    latency_sec: float,
+    started_at: datetime,
+    stats: RunStats,
+) -> None:
+    session = SessionLocal.session_factory()
+    try:
+        session.add(
+            LlmRun(
+                task_id=task_id,
+                job_id=job_id,
+                agent_id=agent_id,
+                project_id=project_id,
+                model=model,
+                outcome=outcome,
+                error=error,
+                cache_hit=stats.cache_hit,
+                retries=stats.retries,
+                queue_wait_sec=queue_wait_sec,
+                mcp_wait_sec=round(stats.mcp_wait_sec, 3),
+                mcp_spawn_sec=round(stats.mcp_spawn_sec, 3),
+                latency_sec=round(latency_sec, 3),
+                model_sec=round(stats.model_sec, 3),
+                tool_calls=stats.tool_calls,
+                tool_sec=round(stats.tool_sec, 3),
+                tool_cache_hits=stats.tool_cache_hits,
+                tool_cache_misses=stats.tool_cache_misses,
+                requests=stats.requests,
+                input_tokens=stats.input_tokens,
+                output_tokens=stats.output_tokens,
+                total_tokens=stats.total_tokens,
+                started_at=started_at,
+                finished_at=utcnow(),
+            )
+        )
+        session.commit()
+    except Exception as exc:  # pragma: no cover - телеметрия не должна ломать запуск
+        session.rollback()
+        print(f"[llm] Не удалось записать телеметрию запуска: {exc}")
+    finally:
+        session.close()
+
+
+def _aggregate(runs: list[LlmRun]) -> dict[str, object]:
+    outcomes: dict[str, int] = defaultdict(int)
+    for run in runs:
+        outcomes[run.outcome] += 1
+    payload: dict[str, object] = {
+        "runs": len(runs),
+        "outcomes": dict(outcomes),
+        "cache_hits": sum(1 for run in runs if run.cache_hit),
+    }
+    for field in _SUM_FIELDS:
+        payload[f"{field}_sum"] = sum(getattr(run, field) or 0 for run in runs)
+    for field in _PERCENTILE_FIELDS:
+        values = sorted(getattr(run, field) for run in runs if getattr(run, field) is not None)
+        payload[field] = {
+            "p50": round(percentile(values, 0.5), 3),
+            "p95": round(percentile(values, 0.95), 3),
+            "p99": round(percentile(values, 0.99), 3),
+        }
+    return payload
+
+
+def get_llm_metrics(hours: float | None = None) -> dict[str, object]:
+    window = hours if hours and hours > 0 else LLM_METRICS_WINDOW_HOURS
+    session = SessionLocal()
+    runs = (
+        session.execute(
+            select(LlmRun)
+            .where(LlmRun.started_at >= utcnow() - timedelta(hours=window))
+            .order_by(LlmRun.started_at.desc())
+            .limit(LLM_METRICS_MAX_RUNS)
+        )
+        .scalars()
+        .all()
+    )
+    groups: dict[str, dict[object, list[LlmRun]]] = {
+        "by_agent": defaultdict(list),
+        "by_model": defaultdict(list),
+        "by_project": defaultdict(list),
+    }
+    for run in runs:
+        groups["by_agent"][run.agent_id].append(run)
+        groups["by_model"][run.model].append(run)
+        groups["by_project"][run.project_id].append(run)
+    payload: dict[str, object] = {"window_hours": window, "overall": _aggregate(list(runs))}
+    for name, grouped in groups.items():
+        payload[name] = {str(key): _aggregate(items) for key, items in grouped.items()}
+    return payload
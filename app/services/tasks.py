@@ -1,60 +1,182 @@
 from __future__ import annotations
 
 from collections import defaultdict
-from threading import Lock
-from sqlalchemy import select
+from concurrent.futures import CancelledError
+import os
+import queue
+from threading import Lock, Thread
+import time
+
+from sqlalchemy import func, select
 from sqlalchemy.orm import selectinload
 
 from ..db import SessionLocal
 from llm.codex import run_task_prompt
+from llm.telemetry import RunStats
+from app.scheduler import PRIORITY_AGENT, llm_scheduler
 from app.socketio import socketio
-from ..models import Agent, Message, Project, Settings, Status, Task
-
-_RUNNING_TASK_IDS: set[int] = set()
-_RUNNING_TASK_IDS_LOCK = Lock()
-
-
-def _set_task_running(task_id: int, is_running: bool) -> None:
-    with _RUNNING_TASK_IDS_LOCK:
-        if is_running:
-            _RUNNING_TASK_IDS.add(task_id)
-        else:
-            _RUNNING_TASK_IDS.discard(task_id)
+from ..models import Agent, AgentAssignment, Message, Project, Settings, Status, Task
+from . import llm_cache as llm_cache_service
+from . import llm_context as llm_context_service
+from . import llm_jobs as llm_jobs_service
+from . import llm_runs as llm_runs_service
+
+LLM_STREAM_EMIT_SEC = float(os.getenv("LLM_STREAM_EMIT_SEC", "0.5"))
+
+
+_EMITS: queue.SimpleQueue[tuple[str, dict[str, object]]] = queue.SimpleQueue()
+_EMIT_THREAD_LOCK = Lock()
+_emit_thread: Thread | None = None
+
+
+def _emit_in_order(event: str, payload: dict[str, object]) -> None:
+    """Отправляет событие запуска из отдельного потока, сохраняя порядок событий.
+
+    Дельты приходят из общего event loop запусков, а с SOCKETIO_MESSAGE_QUEUE
+    emit ходит в сеть и остановил бы все идущие запуски.
+    """
+    global _emit_thread
+    with _EMIT_THREAD_LOCK:
+        if _emit_thread is None:
+            _emit_thread = Thread(target=_emit_loop, name="llm-emit", daemon=True)
+            _emit_thread.start()
+    _EMITS.put((event, payload))
+
+
+def _emit_loop() -> None:
+    while True:
+        event, payload = _EMITS.get()
+        try:
+            socketio.emit(event, payload)
+        except Exception as exc:  # pragma: no cover - ошибки очереди сообщений
+            print(f"[llm] Не удалось отправить событие {event}: {exc}")
+
+
+class _LlmDeltaEmitter:
+    def __init__(self, task_id: int) -> None:
+        self.task_id = task_id
+        self._chunks: list[str] = []
+        self._reset = False
+        self._emitted_at = time.monotonic()
+        self._lock = Lock()
+
+    def push(self, payload: dict[str, str]) -> None:
+        kind = payload.get("kind")
+        text = payload.get("text") or ""
+        with self._lock:
+            if kind == "reset":
+                self._chunks.clear()
+                self._reset = True
+            elif kind == "tool":
+                self._chunks.append(f"\n[{text}]\n")
+            else:
+                self._chunks.append(text)
+            if time.monotonic() - self._emitted_at < LLM_STREAM_EMIT_SEC:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._emitted_at = time.monotonic()
+            if not self._chunks and not self._reset:
+                return
+            text = "".join(self._chunks)
+            reset = self._reset
+            self._chunks.clear()
+            self._reset = False
+        _emit_in_order("task_llm_delta", {"task_id": self.task_id, "text": text, "reset": reset})
 
 
 def get_running_task_ids() -> set[int]:
-    with _RUNNING_TASK_IDS_LOCK:
-        return set(_RUNNING_TASK_IDS)
+    return llm_jobs_service.get_running_task_ids()
 
 
-def _sync_task_assignment(session, task: Task) -> None:
-    assigned_agent = (
-        session.execute(select(Agent).where(Agent.current_task_id == task.id))
+def _sync_task_assignment(session, task: Task) -> Agent | None:
+    assignment = (
+        session.execute(
+            select(AgentAssignment)
+            .options(selectinload(AgentAssignment.agent))
+            .where(AgentAssignment.task_id == task.id)
+        )
         .scalars()
         .first()
     )
-    if assigned_agent and assigned_agent.working_status_id != task.status_id:
-        assigned_agent.current_task_id = None
-        assigned_agent = None
-
-    if assigned_agent:
-        return
+    if assignment and assignment.agent.working_status_id == task.status_id:
+        return assignment.agent
+    released_status_id = assignment.agent.working_status_id if assignment else None
 
+    load = func.count(AgentAssignment.id)
     available_agent = (
         session.execute(
             select(Agent)
-            .where(
-                Agent.working_status_id == task.status_id,
-                Agent.current_task_id.is_(None),
+            .outerjoin(Agent.assignments)
+            .where(Agent.working_status_id == task.status_id)
+            .group_by(Agent.id)
+            .having(load < Agent.max_concurrency)
+            .order_by(load, Agent.name)
+        )
+        .scalars()
+        .first()
+    )
+    if not available_agent:
+        if assignment:
+            session.delete(assignment)
+    elif assignment:
+        assignment.agent = available_agent
+        assignment.assigned_at = llm_runs_service.utcnow()
+    else:
+        session.add(
+            AgentAssignment(
+                agent_id=available_agent.id,
+                task_id=task.id,
+                assigned_at=llm_runs_service.utcnow(),
             )
-            .order_by(Agent.name)
+        )
+    if released_status_id is not None:
+        session.flush()
+        _assign_waiting_task(session, released_status_id)
+    return available_agent
+
+
+def assign_waiting_tasks(session, status_id: int, limit: int) -> None:
+    """Раздает до `limit` задач статуса, ждущих агента, по свободным местам агентов.
+
+    Нужно, когда места появляются не от завершения задачи: новый агент, больше
+    реплик или смена рабочего статуса.
+    """
+    for _ in range(limit):
+        if not _assign_waiting_task(session, status_id):
+            return
+
+
+def _assign_waiting_task(session, status_id: int) -> bool:
+    """Отдает освободившееся место агента самой старой задаче статуса без агента.
+
+    Статус такой задачи не меняется, поэтому слушатель смены статуса ее не
+    поставит — задача запоминается в session.info и уходит в очередь после коммита.
+    """
+    waiting = (
+        session.execute(
+            select(Task)
+            .outerjoin(Task.assignment)
+            .where(Task.status_id == status_id, AgentAssignment.id.is_(None))
+            .order_by(Task.id)
         )
         .scalars()
         .first()
     )
-    if available_agent:
-        available_agent.current_task_id = task.id
-        return
+    if waiting is None:
+        return False
+    agent = _sync_task_assignment(session, waiting)
+    if agent is None:
+        return False
+    session.flush()
+    session.info.setdefault("assigned_task_ids", {})[waiting.id] = (
+        waiting.status_id,
+        waiting.project_id,
+        agent.id,
+    )
+    return True
 
 
 def list_tasks() -> list[Task]:
@@ -99,7 +221,7 @@ def get_task_assigned_agent(task_id: int) -> Agent | None:
     session = SessionLocal()
     return (
         session.execute(
-            select(Agent).where(Agent.current_task_id == task_id).order_by(Agent.id)
+            select(Agent).join(Agent.assignments).where(AgentAssignment.task_id == task_id)
         )
         .scalars()
         .first()
@@ -210,14 +332,49 @@ def delete_task(task_id: int) -> str | None:
     if not task:
         return "Задача не найдена."
 
-    agents = session.execute(select(Agent).where(Agent.current_task_id == task.id)).scalars().all()
-    for agent in agents:
-        agent.current_task_id = None
+    released_status_id = task.assignment.agent.working_status_id if task.assignment else None
     session.delete(task)
+    if released_status_id is not None:
+        session.flush()
+        _assign_waiting_task(session, released_status_id)
     session.commit()
     return None
 
 
+def cancel_llm_run(task_id: int) -> tuple[bool, str | None]:
+    session = SessionLocal()
+    if not session.get(Task, task_id):
+        return False, "Задача не найдена."
+    requested = llm_jobs_service.request_cancel(task_id)
+    cancelled_local = llm_scheduler.cancel(task_id)
+    return requested or cancelled_local, None
+
+
+def reject_llm_run(task_id: int, agent_id: int | None, reason: str) -> None:
+    """Переводит задачу в статус ошибки агента, когда запуск не удалось поставить в очередь."""
+    session = SessionLocal.session_factory()
+    try:
+        task = session.get(Task, task_id)
+        if not task:
+            return
+        agent = session.get(Agent, agent_id) if agent_id else None
+        if agent is None:
+            agent = (
+                session.execute(
+                    select(Agent).where(Agent.working_status_id == task.status_id).order_by(Agent.name)
+                )
+                .scalars()
+                .first()
+            )
+        if agent is None:
+            return
+        _handle_llm_error(session, task, agent, reason)
+        session.commit()
+    finally:
+        session.close()
+    socketio.emit("task_llm_rejected", {"task_id": task_id, "error": reason})
+
+
 def _handle_llm_success(session, task: Task, agent: Agent, response: str) -> None:
     session.add(Message(task_id=task.id, author_id=agent.id, text=response))
     if agent.success_status_id:
@@ -232,21 +389,26 @@ def _handle_llm_error(session, task: Task, agent: Agent, error_message: str) ->
     _sync_task_assignment(session, task)
 
 
-def sent_to_llm(task_id: int) -> tuple[Task | None, str | None]:
+def sent_to_llm(
+    task_id: int,
+    job_id: int | None = None,
+    queue_wait_sec: float | None = None,
+) -> tuple[Task | None, str | None]:
     session = SessionLocal.session_factory()
+    session.info["llm_priority"] = PRIORITY_AGENT
     task = session.get(Task, task_id)
     if not task:
         return None, "Задача не найдена."
 
-    _set_task_running(task_id, True)
-    socketio.emit("task_llm_started", {"task_id": task_id})
+    _emit_in_order("task_llm_started", {"task_id": task_id})
+    delta_emitter = _LlmDeltaEmitter(task_id)
 
     agent_name: str | None = None
     agent_status_id: int | None = None
     agent_status_color: str | None = None
 
     try:
-        if session.execute(select(Agent).where(Agent.current_task_id == task.id)).scalar_one_or_none() is None:
+        if task.assignment is None:
             _sync_task_assignment(session, task)
             session.commit()
             session.refresh(task)
@@ -264,8 +426,9 @@ def sent_to_llm(task_id: int) -> tuple[Task | None, str | None]:
         agent = (
             session.execute(
                 select(Agent)
+                .join(Agent.assignments)
                 .options(selectinload(Agent.role), selectinload(Agent.working_status))
-                .where(Agent.current_task_id == task.id)
+                .where(AgentAssignment.task_id == task.id)
             )
             .scalars()
             .first()
@@ -279,14 +442,60 @@ def sent_to_llm(task_id: int) -> tuple[Task | None, str | None]:
         settings = session.execute(select(Settings)).scalars().first()
         api_key = settings.api_key if settings else None
         model = settings.model if settings else None
-        response, is_completed, error_message = run_task_prompt(
-            agent,
-            last_message.text,
-            api_key,
-            model,
-            task.id,
-            task.status_id,
-        )
+        prompt = llm_context_service.build_task_prompt(task.id) or last_message.text
+        started_status_id = task.status_id
+        stats = RunStats()
+        run_started_at = llm_runs_service.utcnow()
+        run_started = time.monotonic()
+        run_agent_id = agent.id
+        run_project_id = task.project_id
+
+        def _record_run(outcome: str, error: str | None = None) -> None:
+            llm_runs_service.record_run(
+                task_id=task_id,
+                job_id=job_id,
+                agent_id=run_agent_id,
+                project_id=run_project_id,
+                model=model,
+                outcome=outcome,
+                error=error,
+                queue_wait_sec=queue_wait_sec,
+                latency_sec=time.monotonic() - run_started,
+                started_at=run_started_at,
+                stats=stats,
+            )
+
+        try:
+            response, is_completed, error_message = run_task_prompt(
+                agent,
+                prompt,
+                api_key,
+                model,
+                task.id,
+                task.status_id,
+                on_delta=delta_emitter.push,
+                response_cache=llm_cache_service.get_response_cache(agent),
+                settings=settings,
+                stats=stats,
+            )
+        except CancelledError:
+            _record_run(llm_runs_service.OUTCOME_CANCELLED)
+            return task, "Запуск отменен."
+        session.refresh(task)
+        if task.status_id != started_status_id:
+            _record_run(llm_runs_service.OUTCOME_DISCARDED)
+            print(f"[llm] Задача {task.id} перемещена во время запуска, результат отброшен.")
+            return task, None
+
+        if error_message:
+            _record_run(llm_runs_service.OUTCOME_FAILED, error_message)
+        elif response and is_completed:
+            _record_run(llm_runs_service.OUTCOME_SUCCEEDED)
+        elif response:
+            _record_run(llm_runs_service.OUTCOME_AGENT_ERROR)
+        else:
+            _record_run(llm_runs_service.OUTCOME_FAILED, "Codex-agent не вернул результат.")
+
         if error_message:
             _handle_llm_error(session, task, agent, error_message)
             session.commit()
@@ -307,8 +516,9 @@ def sent_to_llm(task_id: int) -> tuple[Task | None, str | None]:
         session.commit()
         return task, error_message
     finally:
-        _set_task_running(task_id, False)
-        socketio.emit(
+        session.close()
+        delta_emitter.flush()
+        _emit_in_order(
             "task_llm_finished",
             {
                 "task_id": task_id,
@@ -1,6 +1,11 @@
 from __future__ import annotations
 
+import os
+
 from flask_socketio import SocketIO
 
 
-socketio = SocketIO(async_mode="threading")
+socketio = SocketIO(
+    async_mode="threading",
+    message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE") or None,
+)
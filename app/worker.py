@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+import time
+
+from . import create_app
+from .scheduler import llm_scheduler
+
+
+def main() -> None:
+    create_app()
+    llm_scheduler.start()
+    print(
+        f"[worker] {llm_scheduler.worker_id}: запущено {llm_scheduler.workers} воркеров LLM."
+    )
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
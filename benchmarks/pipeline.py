@@ -0,0 +1,502 @@
+from __future__ import annotations
+
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DEFAULT_MODEL = "fake:latency=200ms,tools=1,tokens=120"
+WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE")
+LOCK_MARKERS = ("database is locked", "database table is locked", "lock timeout", "deadlock")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Сквозной бенчмарк конвейера агентов: смена статуса -> очередь -> MCP -> ответ."
+    )
+    parser.add_argument("--database-url", default=None, help="БД для прогона (по умолчанию временная SQLite)")
+    parser.add_argument("--projects", type=int, default=2)
+    parser.add_argument("--stages", type=int, default=2, help="статусов с агентами в каждом проекте")
+    parser.add_argument("--agents", type=int, default=2, help="агентов на каждом этапе")
+    parser.add_argument("--replicas", type=int, default=1, help="параллельных задач у каждого агента")
+    parser.add_argument("--tasks", type=int, default=10, help="задач в каждом проекте")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="модель, обычно fake:...")
+    parser.add_argument("--api-share", type=float, default=0.5, help="доля задач, запускаемых через REST API")
+    parser.add_argument("--rate", type=float, default=0.0, help="предел запусков задач в секунду (0 — без предела)")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик аллокаций Python")
+    parser.add_argument("--output", default="benchmark-report.json", help="файл отчета или '-'")
+    return parser.parse_args(argv)
+
+
+def _prepare_env(args: argparse.Namespace) -> str:
+    url = args.database_url or os.getenv("DATABASE_URL")
+    if not url:
+        url = f"sqlite:///{tempfile.mkdtemp(prefix='kb-bench-')}/kb.db"
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("LLM_DEBOUNCE_SEC", "0")
+    os.environ.setdefault("LLM_POLL_SEC", "0.2")
+    os.environ.setdefault("CODEX_SANDBOX_DIR", tempfile.mkdtemp(prefix="kb-bench-sandbox-"))
+    return url
+
+
+def _migrate() -> None:
+    # migrations/env.py добавляет app/ в sys.path, поэтому миграции идут в отдельном процессе.
+    subprocess.run([sys.executable, "-m", "alembic", "upgrade", "head"], cwd=ROOT, check=True)
+
+
+def _summary(values: list[float]) -> dict[str, float]:
+    from app.services.llm_jobs import percentile
+
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "avg": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 0.5), 4),
+        "p95": round(percentile(values, 0.95), 4),
+        "p99": round(percentile(values, 0.99), 4),
+        "max": round(values[-1], 4) if values else 0.0,
+    }
+
+
+class DbProbe:
+    """Замеряет время запросов и коммитов (flush + COMMIT) и считает ошибки блокировок."""
+
+    def __init__(self, engine) -> None:
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        self.reads: list[float] = []
+        self.writes: list[float] = []
+        self.commits: list[float] = []
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._on_error)
+        event.listen(Session, "before_commit", self._before_commit)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_rollback)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info["bench_execute_at"] = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        started_at = conn.info.pop("bench_execute_at", None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+        with self._lock:
+            if statement.lstrip().upper().startswith(WRITE_PREFIXES):
+                self.writes.append(elapsed)
+            else:
+                self.reads.append(elapsed)
+
+    def _before_commit(self, session) -> None:
+        session.info["bench_commit_at"] = time.perf_counter()
+
+    def _after_commit(self, session) -> None:
+        started_at = session.info.pop("bench_commit_at", None)
+        if started_at is not None:
+            with self._lock:
+                self.commits.append(time.perf_counter() - started_at)
+
+    def _after_rollback(self, session) -> None:
+        session.info.pop("bench_commit_at", None)
+
+    def _on_error(self, context) -> None:
+        message = str(context.original_exception).lower()
+        if any(marker in message for marker in LOCK_MARKERS):
+            with self._lock:
+                self.lock_errors += 1
+
+    def report(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                "lock_errors": self.lock_errors,
+                "read_sec": _summary(self.reads),
+                "write_sec": _summary(self.writes),
+                "commit_sec": _summary(self.commits),
+            }
+
+
+class MemorySampler:
+    """Периодически снимает RSS процесса и его дочерних процессов (MCP-серверов)."""
+
+    def __init__(self, interval_sec: float = 0.5) -> None:
+        self.interval_sec = interval_sec
+        self.peak_children_kb = 0
+        self.peak_children = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-memory", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_sec):
+            pids = _child_pids()
+            self.peak_children = max(self.peak_children, len(pids))
+            self.peak_children_kb = max(self.peak_children_kb, sum(_rss_kb(pid) for pid in pids))
+
+
+def _child_pids() -> list[int]:
+    pids: list[int] = []
+    for path in glob.glob(f"/proc/{os.getpid()}/task/*/children"):
+        try:
+            with open(path, encoding="utf-8") as handle:
+                pids.extend(int(pid) for pid in handle.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _rss_kb(pid: int | str) -> int:
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as handle:
+            for line in handle:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def seed(
+    prefix: str, projects: int, stages: int, agents_per_stage: int, replicas: int, tasks: int
+) -> list[dict[str, object]]:
+    from app.db import SessionLocal
+    from app.models import Agent, Column, Message, Project, Role, Status, Task
+
+    session = SessionLocal.session_factory()
+    try:
+        role = Role(name=f"{prefix} исполнитель", instruction="- выполняешь задачи бенчмарка")
+        session.add(role)
+        session.flush()
+
+        plan: list[dict[str, object]] = []
+        for project_index in range(projects):
+            project = Project(name=f"{prefix} проект {project_index + 1}")
+            session.add(project)
+            session.flush()
+
+            names = ["Бэклог"] + [f"Этап {index + 1}" for index in range(stages)] + ["Готово", "Ошибка"]
+            statuses = [Status(name=name, color="#6c757d", project_id=project.id) for name in names]
+            session.add_all(statuses)
+            session.flush()
+            session.add_all(
+                Column(position=index + 1, project_id=project.id, status_id=status.id)
+                for index, status in enumerate(statuses)
+            )
+            done, failed = statuses[-2], statuses[-1]
+
+            agents = []
+            for index in range(stages):
+                for number in range(agents_per_stage):
+                    agent = Agent(
+                        name=f"{prefix} агент {project_index + 1}.{index + 1}.{number + 1}",
+                        role_id=role.id,
+                        project_id=project.id,
+                        working_status_id=statuses[index + 1].id,
+                        success_status_id=statuses[index + 2].id,
+                        error_status_id=failed.id,
+                        acceptance_criteria="- задача из бенчмарка",
+                        transfer_criteria="- ответ получен",
+                        max_concurrency=replicas,
+                    )
+                    session.add(agent)
+                    agents.append(agent)
+            session.flush()
+
+            task_ids = []
+            for index in range(tasks):
+                task = Task(
+                    title=f"Задача {index + 1}",
+                    project_id=project.id,
+                    status_id=statuses[0].id,
+                )
+                session.add(task)
+                session.flush()
+                session.add(
+                    Message(
+                        task_id=task.id,
+                        author_id=agents[0].id,
+                        text=f"{prefix}: задача {project_index + 1}.{index + 1}",
+                    )
+                )
+                task_ids.append(task.id)
+
+            plan.append(
+                {
+                    "project_id": project.id,
+                    "start_status_id": statuses[1].id,
+                    "done_status_id": done.id,
+                    "error_status_id": failed.id,
+                    "task_ids": task_ids,
+                }
+            )
+        session.commit()
+        return plan
+    finally:
+        session.close()
+
+
+def _set_model(model: str) -> str:
+    from app.services import settings as settings_service
+
+    settings = settings_service.get_settings()
+    previous = settings.model
+    settings_service.update_settings(settings.api_key, model, settings.instructions, settings.config)
+    return previous
+
+
+def _move(client, task_id: int, status_id: int, via_api: bool) -> None:
+    from app.db import SessionLocal
+    from app.services import tasks as tasks_service
+
+    if via_api:
+        response = client.patch(f"/api/tasks/{task_id}/status", json={"status_id": status_id})
+        if response.status_code != 200:
+            print(f"[bench] API вернул {response.status_code} для задачи {task_id}")
+        return
+    _, error = tasks_service.update_task_status(task_id, str(status_id))
+    SessionLocal.remove()
+    if error:
+        print(f"[bench] Не удалось сменить статус задачи {task_id}: {error}")
+
+
+def _terminal_statuses(task_ids: list[int], terminal: dict[int, str]) -> dict[int, str]:
+    from sqlalchemy import select
+
+    from app.db import SessionLocal
+    from app.models import Task
+
+    if not task_ids:
+        return {}
+    session = SessionLocal.session_factory()
+    try:
+        rows = session.execute(select(Task.id, Task.status_id).where(Task.id.in_(task_ids))).all()
+    finally:
+        session.close()
+    return {task_id: terminal[status_id] for task_id, status_id in rows if status_id in terminal}
+
+
+def _drive(
+    app,
+    plan: list[dict[str, object]],
+    window: int,
+    api_share: float,
+    rate: float,
+    timeout: float,
+) -> tuple[dict[int, float], dict[int, tuple[float, str]]]:
+    """Закрытый цикл: в каждом проекте одновременно в работе не больше `window` задач.
+
+    Задачи сверх емкости этапа ждали бы освободившегося агента в очереди; окно
+    держит нагрузку замкнутой, чтобы ожидание в очереди не росло с длиной бэклога.
+    """
+    client = app.test_client()
+    terminal: dict[int, str] = {}
+    for project in plan:
+        terminal[project["done_status_id"]] = "done"
+        terminal[project["error_status_id"]] = "error"
+    backlog = {index: list(project["task_ids"]) for index, project in enumerate(plan)}
+    in_flight: dict[int, set[int]] = {index: set() for index in backlog}
+    submitted_at: dict[int, float] = {}
+    finished: dict[int, tuple[float, str]] = {}
+    api_every = round(1 / api_share) if api_share > 0 else 0
+    deadline = time.monotonic() + timeout
+    while (any(backlog.values()) or any(in_flight.values())) and time.monotonic() < deadline:
+        for index, project in enumerate(plan):
+            while backlog[index] and len(in_flight[index]) < window:
+                task_id = backlog[index].pop(0)
+                via_api = bool(api_every) and len(submitted_at) % api_every == 0
+                submitted_at[task_id] = time.monotonic()
+                in_flight[index].add(task_id)
+                _move(client, task_id, project["start_status_id"], via_api)
+                if rate > 0:
+                    time.sleep(1 / rate)
+        active = [task_id for tasks in in_flight.values() for task_id in tasks]
+        now = time.monotonic()
+        for task_id, outcome in _terminal_statuses(active, terminal).items():
+            finished[task_id] = (now, outcome)
+            for tasks in in_flight.values():
+                tasks.discard(task_id)
+        time.sleep(0.1)
+    return submitted_at, finished
+
+
+def _collect(task_ids: list[int]) -> dict[str, object]:
+    from sqlalchemy import select
+
+    from app.db import SessionLocal
+    from app.models import LlmJob, LlmRun
+
+    session = SessionLocal.session_factory()
+    try:
+        runs = session.execute(select(LlmRun).where(LlmRun.task_id.in_(task_ids))).scalars().all()
+        jobs = session.execute(select(LlmJob).where(LlmJob.task_id.in_(task_ids))).scalars().all()
+    finally:
+        session.close()
+
+    jobs_by_id = {job.id: job for job in jobs}
+    overhead = []
+    for run in runs:
+        job = jobs_by_id.get(run.job_id)
+        if job and job.started_at and job.finished_at:
+            job_sec = (job.finished_at - job.started_at).total_seconds()
+            overhead.append(max(0.0, job_sec - run.model_sec - run.tool_sec))
+    return {
+        "runs": {
+            "total": len(runs),
+            "outcomes": dict(Counter(run.outcome for run in runs)),
+            "retries": sum(run.retries for run in runs),
+            "cache_hits": sum(1 for run in runs if run.cache_hit),
+            "tool_calls": sum(run.tool_calls for run in runs),
+            "tool_cache_hits": sum(run.tool_cache_hits for run in runs),
+            "tool_cache_misses": sum(run.tool_cache_misses for run in runs),
+            "total_tokens": sum(run.total_tokens for run in runs),
+        },
+        "jobs": dict(Counter(job.state for job in jobs)),
+        "latency_sec": _summary([run.latency_sec for run in runs]),
+        "queue_wait_sec": _summary([run.queue_wait_sec for run in runs if run.queue_wait_sec is not None]),
+        "job_wait_sec": _summary(
+            [(job.started_at - job.created_at).total_seconds() for job in jobs if job.started_at]
+        ),
+        "mcp_wait_sec": _summary([run.mcp_wait_sec for run in runs]),
+        "model_sec": _summary([run.model_sec for run in runs]),
+        "tool_sec": _summary([run.tool_sec for run in runs]),
+        "overhead_sec": _summary(overhead),
+    }
+
+
+def _shutdown() -> None:
+    from llm import runtime
+    from llm.mcp_pool import get_pool
+
+    try:
+        runtime.run(get_pool().close(), timeout=10)
+    except Exception as exc:
+        print(f"[bench] Не удалось остановить пул MCP: {exc!r}")
+
+
+def run(args: argparse.Namespace) -> dict[str, object]:
+    url = _prepare_env(args)
+    if args.tracemalloc:
+        tracemalloc.start()
+    _migrate()
+
+    from app import create_app
+    from app.db import engine
+    from app.scheduler import llm_scheduler
+
+    app = create_app()
+    probe = DbProbe(engine)
+    prefix = f"bench-{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+    plan = seed(prefix, args.projects, args.stages, args.agents, args.replicas, args.tasks)
+    previous_model = _set_model(args.model)
+    task_ids = [task_id for project in plan for task_id in project["task_ids"]]
+
+    sampler = MemorySampler()
+    sampler.start()
+    rss_before_kb = _rss_kb("self")
+    llm_scheduler.start()
+    started = time.monotonic()
+    try:
+        submitted_at, finished = _drive(
+            app, plan, args.agents * args.replicas, args.api_share, args.rate, args.timeout
+        )
+    finally:
+        elapsed = time.monotonic() - started
+        sampler.stop()
+        _set_model(previous_model)
+        _shutdown()
+
+    outcomes = Counter(outcome for _, outcome in finished.values())
+    end_to_end = [finished_at - submitted_at[task_id] for task_id, (finished_at, _) in finished.items()]
+    last_finished = max((finished_at for finished_at, _ in finished.values()), default=started)
+    busy_sec = max(last_finished - started, 1e-9)
+    report = {
+        "started_at": prefix.removeprefix("bench-"),
+        "database": engine.dialect.name,
+        "database_url": engine.url.render_as_string(hide_password=True),
+        "config": {
+            "projects": args.projects,
+            "stages": args.stages,
+            "agents_per_stage": args.agents,
+            "replicas": args.replicas,
+            "tasks_per_project": args.tasks,
+            "model": args.model,
+            "api_share": args.api_share,
+            "rate": args.rate,
+            "workers": llm_scheduler.workers,
+            "debounce_sec": float(os.environ["LLM_DEBOUNCE_SEC"]),
+        },
+        "tasks": {
+            "total": len(task_ids),
+            "done": outcomes.get("done", 0),
+            "error": outcomes.get("error", 0),
+            "timed_out": len(task_ids) - len(finished),
+        },
+        "elapsed_sec": round(elapsed, 3),
+        "throughput": {
+            "tasks_per_min": round(len(finished) / busy_sec * 60, 2),
+            "stage_runs_per_min": round(len(finished) * args.stages / busy_sec * 60, 2),
+        },
+        "end_to_end_sec": _summary(end_to_end),
+        **_collect(task_ids),
+        "db": probe.report(),
+        "memory": {
+            "rss_before_kb": rss_before_kb,
+            "rss_after_kb": _rss_kb("self"),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "mcp_processes_peak": sampler.peak_children,
+            "mcp_rss_peak_kb": sampler.peak_children_kb,
+        },
+    }
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report["memory"]["python_current_kb"] = current // 1024
+        report["memory"]["python_peak_kb"] = peak // 1024
+    if url.startswith("sqlite"):
+        report["database_url"] = url
+    return report
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+        print(f"[bench] Отчет записан в {args.output}")
+    tasks = report["tasks"]
+    print(
+        f"[bench] {tasks['done'] + tasks['error']}/{tasks['total']} задач за {report['elapsed_sec']} с, "
+        f"{report['throughput']['tasks_per_min']} задач/мин, "
+        f"p95 ожидания в очереди {report['queue_wait_sec']['p95']} с"
+    )
+
+
+if __name__ == "__main__":
+    main()
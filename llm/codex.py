@@ -1,19 +1,46 @@
 from __future__ import annotations
 
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
 from dataclasses import dataclass
+import hashlib
+import json
 import os
 import re
-import sys
-import time
+import threading
+from typing import Callable, Protocol
+import uuid
 
 import anyio
 
-from app.models import Agent
+from app.models import Agent, Settings
 from app.services import settings as settings_service
+from . import runtime
+from .mcp_pool import get_pool
+from .model_names import is_fake_model
+from .resilience import (
+    CircuitOpenError,
+    CodexToolError,
+    backoff_delay,
+    get_breaker,
+    is_retryable,
+)
+from .sandbox_paths import CODEX_WORKTREES, sandbox_revision, task_branch
+from .telemetry import RunStats
 
 LLM_TIMEOUT_SEC = int(os.getenv("LLM_TIMEOUT_SEC", "120"))
 LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
-LLM_RETRY_BACKOFF_SEC = float(os.getenv("LLM_RETRY_BACKOFF_SEC", "2"))
+LLM_CANCEL_TIMEOUT_SEC = float(os.getenv("LLM_CANCEL_TIMEOUT_SEC", "5"))
+LLM_INSTRUCTIONS_CACHE_SIZE = int(os.getenv("LLM_INSTRUCTIONS_CACHE_SIZE", "256"))
+
+DeltaCallback = Callable[[dict[str, str]], None]
+
+
+class ResponseCache(Protocol):
+    def get(self, key: str) -> str | None: ...
+
+    def set(self, key: str, response: str) -> None: ...
 
 
 @dataclass(slots=True)
@@ -27,44 +54,140 @@ class CodexAgent:
         prompt: str,
         task_id: int | None = None,
         status_id: int | None = None,
+        on_delta: DeltaCallback | None = None,
+        stats: RunStats | None = None,
     ) -> str | None:
+        return self.submit(
+            prompt, task_id=task_id, status_id=status_id, on_delta=on_delta, stats=stats
+        ).result()
+
+    def submit(
+        self,
+        prompt: str,
+        task_id: int | None = None,
+        status_id: int | None = None,
+        on_delta: DeltaCallback | None = None,
+        stats: RunStats | None = None,
+    ) -> Future[str | None]:
         if not prompt:
-            return None
-        if not self.api_key:
-            raise ValueError("Не задан API_KEY в настройках.")
+            future: Future[str | None] = Future()
+            future.set_result(None)
+            return future
         if not self.model:
             raise ValueError("Не задан MODEL в настройках.")
-        response = _run_mcp_codex(
-            prompt=prompt,
-            instructions=self.instructions,
-            api_key=self.api_key,
-            model=self.model,
-            task_id=task_id,
-            status_id=status_id,
+        if not self.api_key and not is_fake_model(self.model):
+            raise ValueError("Не задан API_KEY в настройках.")
+        future = runtime.submit(
+            _run_mcp_codex(
+                prompt=prompt,
+                instructions=self.instructions,
+                api_key=self.api_key or "",
+                model=self.model,
+                task_id=task_id,
+                status_id=status_id,
+                on_delta=on_delta,
+                stats=stats,
+            )
         )
-        return response or None
+        if task_id is not None:
+            _track_run(task_id, future)
+        return future
+
+
+_ACTIVE_RUNS: dict[int, Future] = {}
+_ACTIVE_RUNS_LOCK = threading.Lock()
+
+
+def _track_run(task_id: int, future: Future) -> None:
+    with _ACTIVE_RUNS_LOCK:
+        _ACTIVE_RUNS[task_id] = future
+
+    def _forget(done: Future) -> None:
+        with _ACTIVE_RUNS_LOCK:
+            if _ACTIVE_RUNS.get(task_id) is done:
+                del _ACTIVE_RUNS[task_id]
+
+    future.add_done_callback(_forget)
+
+
+def cancel_task_run(task_id: int) -> bool:
+    with _ACTIVE_RUNS_LOCK:
+        future = _ACTIVE_RUNS.get(task_id)
+    if future is None:
+        return False
+    return future.cancel()
+
 
+_INSTRUCTIONS: OrderedDict[tuple[int, int, int, int, int], str] = OrderedDict()
+_INSTRUCTIONS_LOCK = threading.Lock()
+
+
+def _instructions_key(agent: Agent, settings: Settings) -> tuple[int, int, int, int, int]:
+    role_version = agent.role.version if agent.role else 0
+    return (settings.version or 0, agent.role_id, role_version or 0, agent.id, agent.version or 0)
+
+
+def build_codex_instructions(agent: Agent, settings: Settings | None = None) -> str:
+    if settings is None:
+        settings = settings_service.get_settings()
+    key = _instructions_key(agent, settings)
+    with _INSTRUCTIONS_LOCK:
+        cached = _INSTRUCTIONS.get(key)
+        if cached is not None:
+            _INSTRUCTIONS.move_to_end(key)
+    if cached is not None:
+        return cached
 
-def build_codex_instructions(agent: Agent) -> str:
     parts: list[str] = []
-    base_instructions = settings_service.get_settings().instructions
-    if base_instructions:
-        parts.append(base_instructions.strip())
+    if settings.instructions:
+        parts.append(settings.instructions.strip())
     if agent.role and agent.role.instruction:
         parts.append(agent.role.instruction.strip())
     if agent.acceptance_criteria:
         parts.append(f"Критерии приемки: {agent.acceptance_criteria.strip()}")
     if agent.transfer_criteria:
         parts.append(f"Критерии передачи: {agent.transfer_criteria.strip()}")
-    return "\n".join(parts).strip()
+    instructions = "\n".join(parts).strip()
+    with _INSTRUCTIONS_LOCK:
+        # Старые версии инструкций той же пары роль/агент больше не понадобятся.
+        for stale in [item for item in _INSTRUCTIONS if item[1] == key[1] and item[3] == key[3]]:
+            del _INSTRUCTIONS[stale]
+        _INSTRUCTIONS[key] = instructions
+        while len(_INSTRUCTIONS) > max(1, LLM_INSTRUCTIONS_CACHE_SIZE):
+            _INSTRUCTIONS.popitem(last=False)
+    return instructions
+
+
+def invalidate_codex_instructions(
+    settings_changed: bool = False,
+    role_ids: set[int] | None = None,
+    agent_ids: set[int] | None = None,
+) -> None:
+    role_ids = role_ids or set()
+    agent_ids = agent_ids or set()
+    with _INSTRUCTIONS_LOCK:
+        if settings_changed:
+            _INSTRUCTIONS.clear()
+        else:
+            for key in [item for item in _INSTRUCTIONS if item[1] in role_ids or item[3] in agent_ids]:
+                del _INSTRUCTIONS[key]
+    if settings_changed:
+        _CODEX_AGENTS.clear()
+    for agent_id in agent_ids:
+        _CODEX_AGENTS.pop(agent_id, None)
 
 
 _CODEX_AGENTS: dict[int, CodexAgent] = {}
 
 
-def register_codex_agent(agent: Agent, api_key: str | None, model: str | None) -> CodexAgent:
+def register_codex_agent(
+    agent: Agent,
+    api_key: str | None,
+    model: str | None,
+    settings: Settings | None = None,
+) -> CodexAgent:
     codex_agent = CodexAgent(
-        instructions=build_codex_instructions(agent),
+        instructions=build_codex_instructions(agent, settings),
         api_key=api_key,
         model=model,
     )
@@ -110,7 +233,7 @@ def _extract_tool_text(result) -> str:
     return "\n".join(parts).strip()
 
 
-def _run_mcp_codex(
+async def _run_mcp_codex(
     *,
     prompt: str,
     instructions: str | None,
@@ -118,24 +241,33 @@ def _run_mcp_codex(
     model: str,
     task_id: int | None = None,
     status_id: int | None = None,
+    on_delta: DeltaCallback | None = None,
+    stats: RunStats | None = None,
 ) -> str | None:
-    try:
-        from mcp.client.session import ClientSession
-        from mcp.client.stdio import StdioServerParameters, stdio_client
-    except ModuleNotFoundError as exc:  # pragma: no cover - environment-specific
-        raise RuntimeError(
-            "Пакет 'mcp' не установлен. Установите зависимости или запускайте через Docker."
-        ) from exc
+    pool = get_pool()
+
+    async def _on_progress(progress: float, total: float | None, message: str | None) -> None:
+        if on_delta is None or not message:
+            return
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            payload = {"kind": "text", "text": message}
+        on_delta(payload)
+
+    async def _cancel_remote(session, run_id: str) -> None:
+        with anyio.CancelScope(shield=True):
+            with anyio.move_on_after(LLM_CANCEL_TIMEOUT_SEC):
+                try:
+                    await session.call_tool("cancel_run", {"run_id": run_id})
+                except Exception as exc:
+                    print(f"[codex] не удалось отменить запуск {run_id}: {exc!r}")
 
     async def _run() -> str | None:
-        server_params = StdioServerParameters(
-            command=sys.executable,
-            args=["-m", "llm.mcp_server"],
-        )
-        async with stdio_client(server_params) as streams:
-            async with ClientSession(*streams) as session:
-                await session.initialize()
-                with anyio.fail_after(LLM_TIMEOUT_SEC):
+        run_id = uuid.uuid4().hex
+        async with pool.session(stats) as session:
+            with anyio.fail_after(LLM_TIMEOUT_SEC):
+                try:
                     result = await session.call_tool(
                         "run_codex",
                         {
@@ -145,28 +277,64 @@ def _run_mcp_codex(
                             "model": model,
                             "task_id": task_id,
                             "status_id": status_id,
+                            "run_id": run_id,
                         },
+                        progress_callback=_on_progress if on_delta else None,
                     )
+                except asyncio.CancelledError:
+                    await _cancel_remote(session, run_id)
+                    raise
         if getattr(result, "isError", False):
             message = _extract_tool_text(result) or "Codex MCP вернул ошибку."
-            raise RuntimeError(message)
+            raise CodexToolError(message)
+        structured = getattr(result, "structuredContent", None)
+        if stats is not None and isinstance(structured, dict):
+            stats.add_tool_result(structured)
         response_text = _extract_tool_text(result)
         return response_text or None
 
-    last_error: Exception | None = None
-    for attempt in range(LLM_MAX_RETRIES + 1):
+    breaker = get_breaker(model, api_key)
+    attempt = 0
+    while True:
+        breaker.before_call()
         try:
-            return anyio.run(_run)
+            response = await _run()
         except Exception as exc:
-            last_error = exc
-            if attempt < LLM_MAX_RETRIES:
-                time.sleep(LLM_RETRY_BACKOFF_SEC * (attempt + 1))
-                continue
+            if not is_retryable(exc):
+                breaker.release()
+                raise
+            breaker.record_failure()
+            if attempt >= LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            if stats is not None:
+                stats.retries = attempt
+            print(f"[codex] попытка {attempt} не удалась ({exc!r}), повтор через {delay:.1f} с")
+            if on_delta is not None:
+                on_delta({"kind": "reset", "text": ""})
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            breaker.release()
             raise
+        breaker.record_success()
+        return response
+
 
-    if last_error:
-        raise last_error
-    return None
+def build_response_cache_key(
+    instructions: str,
+    prompt: str,
+    model: str | None,
+    task_id: int | None = None,
+) -> str:
+    # С рабочими деревьями изменения файлов остаются в ветке задачи, поэтому ответ,
+    # сохраненный для одной задачи, нельзя отдавать другой даже при той же ревизии.
+    branch = task_branch(task_id) if CODEX_WORKTREES and task_id is not None else ""
+    payload = json.dumps(
+        [instructions, prompt, model or "", sandbox_revision(task_id), branch], ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
 
 def _extract_agent_status(response: str) -> tuple[str, bool | None]:
@@ -191,10 +359,20 @@ def run_task_prompt(
     model: str | None,
     task_id: int | None = None,
     status_id: int | None = None,
+    on_delta: DeltaCallback | None = None,
+    response_cache: ResponseCache | None = None,
+    settings: Settings | None = None,
+    stats: RunStats | None = None,
 ) -> tuple[str | None, bool, str | None]:
     codex_agent = get_codex_agent(agent.id)
-    if not codex_agent or codex_agent.api_key != api_key or codex_agent.model != model:
-        codex_agent = register_codex_agent(agent, api_key, model)
+    instructions = build_codex_instructions(agent, settings)
+    if (
+        not codex_agent
+        or codex_agent.api_key != api_key
+        or codex_agent.model != model
+        or codex_agent.instructions != instructions
+    ):
+        codex_agent = register_codex_agent(agent, api_key, model, settings)
 
     status_instruction = (
         "\n\nВ конце ответа добавь строку строго в формате:\n"
@@ -202,21 +380,41 @@ def run_task_prompt(
         "или\n"
         "STATUS: ERROR\n"
     )
-    try:
-        response = codex_agent.run(
-            f"{prompt}{status_instruction}",
-            task_id=task_id,
-            status_id=status_id,
-        )
-    except Exception as exc:  # pragma: no cover - safety net
-        error_message = f"Ошибка Codex-agent: {exc}"
-        return None, False, error_message
+    full_prompt = f"{prompt}{status_instruction}"
+    cache_key: str | None = None
+    response: str | None = None
+    if response_cache is not None and prompt:
+        cache_key = build_response_cache_key(codex_agent.instructions, full_prompt, model, task_id)
+        response = response_cache.get(cache_key)
+        if response is not None:
+            print(f"[codex] cache hit for agent_id={agent.id}")
+            cache_key = None
+            if stats is not None:
+                stats.cache_hit = True
+            if on_delta is not None:
+                on_delta({"kind": "text", "text": response})
+    if response is None:
+        try:
+            response = codex_agent.run(
+                full_prompt,
+                task_id=task_id,
+                status_id=status_id,
+                on_delta=on_delta,
+                stats=stats,
+            )
+        except (CancelledError, CircuitOpenError):
+            raise
+        except Exception as exc:  # pragma: no cover - safety net
+            error_message = f"Ошибка Codex-agent: {exc}"
+            return None, False, error_message
 
     if not response:
         print(f"[codex] empty response for agent_id={agent.id}")
         return None, False, "Codex-agent не вернул результат."
 
     cleaned_response, is_completed = _extract_agent_status(response)
+    if cache_key is not None and is_completed:
+        response_cache.set(cache_key, response)
     if is_completed is None:
         print("[codex] Агент не указал статус, используем ERROR.")
         return cleaned_response, False, None
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+import random
+import re
+import time
+from typing import Any, AsyncIterator
+
+from agents.items import ModelResponse
+from agents.models.interface import Model
+from agents.usage import Usage
+from openai.types.responses import (
+    Response,
+    ResponseCompletedEvent,
+    ResponseFunctionToolCall,
+    ResponseOutputItemDoneEvent,
+    ResponseOutputMessage,
+    ResponseOutputText,
+    ResponseTextDeltaEvent,
+    ResponseUsage,
+)
+from openai.types.responses.response_usage import InputTokensDetails, OutputTokensDetails
+
+from .model_names import FAKE_MODEL_PREFIX, is_fake_model
+
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)(ms|s)?$")
+
+
+@dataclass(slots=True)
+class FakeModelSpec:
+    latency_sec: float = 0.0
+    jitter_sec: float = 0.0
+    fail_rate: float = 0.0
+    error_rate: float = 0.0
+    tool_calls: int = 0
+    tokens: int = 200
+    chunks: int = 8
+    seed: int = 0
+
+
+def _parse_duration(value: str) -> float:
+    match = _DURATION.match(value)
+    if not match:
+        raise ValueError(f"Invalid duration: {value}")
+    number = float(match.group(1))
+    return number / 1000 if match.group(2) == "ms" else number
+
+
+def _parse_rate(value: str) -> float:
+    rate = float(value[:-1]) / 100 if value.endswith("%") else float(value)
+    if not 0 <= rate <= 1:
+        raise ValueError(f"Invalid rate: {value}")
+    return rate
+
+
+def parse_fake_model(model: str) -> FakeModelSpec:
+    spec = FakeModelSpec()
+    options = model[len(FAKE_MODEL_PREFIX) :] if model.startswith(FAKE_MODEL_PREFIX) else ""
+    for option in filter(None, (item.strip() for item in options.split(","))):
+        name, _, value = option.partition("=")
+        name = name.strip()
+        value = value.strip()
+        if name == "latency":
+            spec.latency_sec = _parse_duration(value)
+        elif name == "jitter":
+            spec.jitter_sec = _parse_duration(value)
+        elif name == "fail":
+            spec.fail_rate = _parse_rate(value)
+        elif name == "error":
+            spec.error_rate = _parse_rate(value)
+        elif name == "tools":
+            spec.tool_calls = max(0, int(value))
+        elif name == "tokens":
+            spec.tokens = max(1, int(value))
+        elif name == "chunks":
+            spec.chunks = max(1, int(value))
+        elif name == "seed":
+            spec.seed = int(value)
+        else:
+            raise ValueError(f"Unknown fake model option: {name}")
+    return spec
+
+
+def _input_text(input: str | list[Any]) -> str:
+    if isinstance(input, str):
+        return input
+    parts: list[str] = []
+    for item in input:
+        content = item.get("content") if isinstance(item, dict) else None
+        if isinstance(content, str):
+            parts.append(content)
+    return "\n".join(parts)
+
+
+def _completed_tool_calls(input: str | list[Any]) -> int:
+    if isinstance(input, str):
+        return 0
+    return sum(
+        1 for item in input if isinstance(item, dict) and item.get("type") == "function_call_output"
+    )
+
+
+class FakeModel(Model):
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.spec = parse_fake_model(model)
+
+    def _rng(self, input: str | list[Any]) -> random.Random:
+        # Генератор на каждый вызов, а не общий на процесс: при нескольких задачах
+        # в полете seed иначе не дает воспроизводимых запусков.
+        key = f"{self.spec.seed}:{_completed_tool_calls(input)}:{_input_text(input)}"
+        return random.Random(int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big"))
+
+    def _plan(
+        self, input: str | list[Any], tools: list[Any], rng: random.Random
+    ) -> tuple[float, list[Any], str, int]:
+        prompt = _input_text(input)
+        turn = _completed_tool_calls(input)
+        if rng.random() < self.spec.fail_rate:
+            raise RuntimeError("Error code: 503 - fake provider failure")
+        latency = self.spec.latency_sec + rng.uniform(0, self.spec.jitter_sec)
+        input_tokens = len(prompt) // 4 + 1
+
+        tool_names = {getattr(tool, "name", None) for tool in tools}
+        if turn < self.spec.tool_calls and "list_files" in tool_names:
+            call = ResponseFunctionToolCall(
+                type="function_call",
+                id=f"fc_{rng.getrandbits(48):x}",
+                call_id=f"call_{rng.getrandbits(48):x}",
+                name="list_files",
+                arguments=json.dumps({"path": "."}),
+                status="completed",
+            )
+            return latency, [call], "", input_tokens
+
+        digest = hashlib.sha256(f"{self.spec.seed}:{prompt}".encode("utf-8")).digest()
+        is_error = int.from_bytes(digest[:4], "big") / 2**32 < self.spec.error_rate
+        words = max(1, self.spec.tokens - 4)
+        body = " ".join(["ok"] * words)
+        status = "ERROR" if is_error else "SUCCESS"
+        text = f"Ответ fake-модели ({turn} вызовов инструментов): {body}\nSTATUS: {status}"
+        message = ResponseOutputMessage(
+            type="message",
+            id=f"msg_{rng.getrandbits(48):x}",
+            role="assistant",
+            status="completed",
+            content=[ResponseOutputText(type="output_text", text=text, annotations=[])],
+        )
+        return latency, [message], text, input_tokens
+
+    def _response(
+        self, output: list[Any], input_tokens: int, text: str, rng: random.Random
+    ) -> Response:
+        output_tokens = self.spec.tokens if text else 20
+        return Response(
+            id=f"resp_{rng.getrandbits(48):x}",
+            created_at=time.time(),
+            model=self.model,
+            object="response",
+            output=output,
+            parallel_tool_calls=False,
+            tool_choice="auto",
+            tools=[],
+            usage=ResponseUsage(
+                input_tokens=input_tokens,
+                input_tokens_details=InputTokensDetails(cached_tokens=0),
+                output_tokens=output_tokens,
+                output_tokens_details=OutputTokensDetails(reasoning_tokens=0),
+                total_tokens=input_tokens + output_tokens,
+            ),
+        )
+
+    async def get_response(
+        self,
+        system_instructions,
+        input,
+        model_settings,
+        tools,
+        output_schema,
+        handoffs,
+        tracing,
+        *,
+        previous_response_id=None,
+        conversation_id=None,
+        prompt=None,
+    ) -> ModelResponse:
+        rng = self._rng(input)
+        latency, output, text, input_tokens = self._plan(input, tools, rng)
+        await asyncio.sleep(latency)
+        response = self._response(output, input_tokens, text, rng)
+        usage = response.usage
+        return ModelResponse(
+            output=response.output,
+            usage=Usage(
+                requests=1,
+                input_tokens=usage.input_tokens,
+                output_tokens=usage.output_tokens,
+                total_tokens=usage.total_tokens,
+            ),
+            response_id=response.id,
+        )
+
+    async def stream_response(
+        self,
+        system_instructions,
+        input,
+        model_settings,
+        tools,
+        output_schema,
+        handoffs,
+        tracing,
+        *,
+        previous_response_id=None,
+        conversation_id=None,
+        prompt=None,
+    ) -> AsyncIterator[Any]:
+        rng = self._rng(input)
+        latency, output, text, input_tokens = self._plan(input, tools, rng)
+        sequence = 0
+        if text:
+            item_id = output[0].id
+            chunks = min(self.spec.chunks, len(text))
+            size = -(-len(text) // chunks)
+            for start in range(0, len(text), size):
+                await asyncio.sleep(latency / chunks)
+                sequence += 1
+                yield ResponseTextDeltaEvent(
+                    type="response.output_text.delta",
+                    item_id=item_id,
+                    output_index=0,
+                    content_index=0,
+                    delta=text[start : start + size],
+                    logprobs=[],
+                    sequence_number=sequence,
+                )
+        else:
+            await asyncio.sleep(latency)
+        for index, item in enumerate(output):
+            sequence += 1
+            yield ResponseOutputItemDoneEvent(
+                type="response.output_item.done",
+                item=item,
+                output_index=index,
+                sequence_number=sequence,
+            )
+        sequence += 1
+        yield ResponseCompletedEvent(
+            type="response.completed",
+            response=self._response(output, input_tokens, text, rng),
+            sequence_number=sequence,
+        )
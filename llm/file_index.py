@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+import os
+from pathlib import Path
+import threading
+from typing import Iterator
+
+CODEX_INDEX_ROOTS = int(os.getenv("CODEX_INDEX_ROOTS", "8"))
+CODEX_INDEX_MAX_BYTES = int(os.getenv("CODEX_INDEX_MAX_BYTES", "67108864"))
+CODEX_INDEX_MAX_FILE_BYTES = int(os.getenv("CODEX_INDEX_MAX_FILE_BYTES", "1048576"))
+BINARY_SNIFF_BYTES = 8192
+IGNORED_DIRNAMES = frozenset({".git", ".worktrees", ".cmd-logs"})
+
+
+@dataclass(slots=True)
+class _Listing:
+    mtime_ns: int
+    dirs: list[str]
+    files: list[str]
+
+
+@dataclass(slots=True)
+class _Text:
+    size: int
+    mtime_ns: int
+    lines: list[str] | None
+
+
+def glob_match(relative: str, pattern: str) -> bool:
+    """Шаблон без `/` сверяется с именем файла, с `/` — с путем от корня."""
+    if "/" not in pattern:
+        return fnmatchcase(relative.rsplit("/", 1)[-1], pattern)
+    if fnmatchcase(relative, pattern):
+        return True
+    return pattern.startswith("**/") and fnmatchcase(relative, pattern[3:])
+
+
+class FileIndex:
+    """Кэш обхода дерева песочницы и текста ее файлов.
+
+    Список каталога перечитывается, только когда меняется его mtime, текст
+    файла — когда меняются его размер или mtime. Запись через инструменты
+    песочницы дополнительно сбрасывает записи явно через `invalidate`.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._listings: dict[str, _Listing] = {}
+        self._texts: dict[str, _Text] = {}
+        self._text_bytes = 0
+        self._lock = threading.Lock()
+
+    def _listing(self, relative: str) -> _Listing | None:
+        path = self.root / relative if relative else self.root
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except OSError:
+            self._listings.pop(relative, None)
+            return None
+        cached = self._listings.get(relative)
+        if cached is not None and cached.mtime_ns == mtime_ns:
+            return cached
+        dirs: list[str] = []
+        files: list[str] = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in IGNORED_DIRNAMES:
+                                dirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            self._listings.pop(relative, None)
+            return None
+        listing = _Listing(mtime_ns, sorted(dirs), sorted(files))
+        self._listings[relative] = listing
+        return listing
+
+    def iter_files(self, start: str = "", max_depth: int | None = None) -> Iterator[str]:
+        """Отдает пути файлов относительно корня в отсортированном порядке."""
+        pending = [(start, 1)]
+        while pending:
+            relative, depth = pending.pop()
+            with self._lock:
+                listing = self._listing(relative)
+            if listing is None:
+                continue
+            prefix = f"{relative}/" if relative else ""
+            for name in listing.files:
+                yield prefix + name
+            if max_depth is None or depth < max_depth:
+                pending.extend((prefix + name, depth + 1) for name in reversed(listing.dirs))
+
+    def lines(self, relative: str) -> list[str] | None:
+        """Строки текстового файла или None для бинарных и слишком больших файлов."""
+        path = self.root / relative
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._texts.get(relative)
+            if cached is not None and (cached.size, cached.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                return cached.lines
+        if stat.st_size > CODEX_INDEX_MAX_FILE_BYTES:
+            return None
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        if b"\0" in data[:BINARY_SNIFF_BYTES]:
+            lines = None
+        else:
+            lines = data.decode("utf-8", errors="replace").splitlines()
+        with self._lock:
+            self._drop_text(relative)
+            if self._text_bytes + stat.st_size <= CODEX_INDEX_MAX_BYTES:
+                self._texts[relative] = _Text(stat.st_size, stat.st_mtime_ns, lines)
+                self._text_bytes += stat.st_size
+        return lines
+
+    def _drop_text(self, relative: str) -> None:
+        cached = self._texts.pop(relative, None)
+        if cached is not None:
+            self._text_bytes -= cached.size
+
+    def invalidate(self, relative: str | None = None) -> None:
+        """Сбрасывает файл и каталоги над ним, а без аргумента — все списки каталогов."""
+        with self._lock:
+            if relative is None:
+                self._listings.clear()
+                return
+            self._drop_text(relative)
+            self._listings.pop(relative, None)
+            while relative:
+                relative = relative.rsplit("/", 1)[0] if "/" in relative else ""
+                self._listings.pop(relative, None)
+
+
+_INDEXES: OrderedDict[Path, FileIndex] = OrderedDict()
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_file_index(root: Path) -> FileIndex:
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(root)
+        if index is None:
+            index = _INDEXES[root] = FileIndex(root)
+            while len(_INDEXES) > max(1, CODEX_INDEX_ROOTS):
+                _INDEXES.popitem(last=False)
+        else:
+            _INDEXES.move_to_end(root)
+        return index
+
+
+def drop_file_index(root: Path) -> None:
+    with _INDEXES_LOCK:
+        _INDEXES.pop(root, None)
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+import os
+import sys
+import threading
+import time
+from typing import AsyncIterator
+
+from .resilience import CodexSetupError
+from .telemetry import RunStats
+
+LLM_MCP_POOL_SIZE = int(os.getenv("LLM_MCP_POOL_SIZE", "2"))
+LLM_MCP_MAX_CALLS = int(os.getenv("LLM_MCP_MAX_CALLS", "50"))
+LLM_MCP_CALLS_PER_PROCESS = int(os.getenv("LLM_MCP_CALLS_PER_PROCESS", "4"))
+LLM_MCP_HEALTHCHECK_SEC = float(os.getenv("LLM_MCP_HEALTHCHECK_SEC", "30"))
+LLM_MCP_START_TIMEOUT_SEC = float(os.getenv("LLM_MCP_START_TIMEOUT_SEC", "60"))
+LLM_MCP_PING_TIMEOUT_SEC = float(os.getenv("LLM_MCP_PING_TIMEOUT_SEC", "5"))
+
+
+class McpProcess:
+    def __init__(self) -> None:
+        self.session = None
+        self.calls = 0
+        self.active = 0
+        self.retiring = False
+        self.is_alive = False
+        self.last_used_at = time.monotonic()
+        self.spawn_sec = 0.0
+        self._error: BaseException | None = None
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        started_at = time.monotonic()
+        self._task = asyncio.create_task(self._serve())
+        try:
+            await asyncio.wait_for(self._ready.wait(), LLM_MCP_START_TIMEOUT_SEC)
+        except asyncio.TimeoutError as exc:
+            await self.close()
+            raise TimeoutError("MCP-сервер не запустился вовремя.") from exc
+        self.spawn_sec = time.monotonic() - started_at
+        if not self.is_alive:
+            if isinstance(self._error, CodexSetupError):
+                raise self._error
+            raise RuntimeError(f"Не удалось запустить MCP-сервер: {self._error}") from self._error
+
+    async def _serve(self) -> None:
+        try:
+            from mcp.client.session import ClientSession
+            from mcp.client.stdio import StdioServerParameters, stdio_client
+        except ModuleNotFoundError:  # pragma: no cover - environment-specific
+            self._error = CodexSetupError(
+                "Пакет 'mcp' не установлен. Установите зависимости или запускайте через Docker."
+            )
+            self._ready.set()
+            return
+
+        server_params = StdioServerParameters(
+            command=sys.executable,
+            args=["-m", "llm.mcp_server"],
+            env=dict(os.environ),
+        )
+        try:
+            async with stdio_client(server_params) as streams:
+                async with ClientSession(*streams) as session:
+                    await session.initialize()
+                    self.session = session
+                    self.is_alive = True
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as exc:
+            self._error = exc
+            print(f"[mcp-pool] процесс MCP завершился с ошибкой: {exc!r}")
+        finally:
+            self.is_alive = False
+            self.session = None
+            self._ready.set()
+
+    async def ping(self) -> bool:
+        if not self.is_alive or self.session is None:
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), LLM_MCP_PING_TIMEOUT_SEC)
+        except Exception as exc:
+            print(f"[mcp-pool] health check не пройден: {exc!r}")
+            return False
+        return True
+
+    async def close(self) -> None:
+        self._stop.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), LLM_MCP_PING_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+
+
+class McpPool:
+    def __init__(
+        self,
+        size: int = LLM_MCP_POOL_SIZE,
+        max_calls: int = LLM_MCP_MAX_CALLS,
+        healthcheck_sec: float = LLM_MCP_HEALTHCHECK_SEC,
+        calls_per_process: int = LLM_MCP_CALLS_PER_PROCESS,
+    ) -> None:
+        self.size = max(1, size)
+        self.max_calls = max(1, max_calls)
+        self.healthcheck_sec = healthcheck_sec
+        self.calls_per_process = max(1, calls_per_process)
+        self._processes: list[McpProcess] = []
+        self._starting = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def session(self, stats: RunStats | None = None) -> AsyncIterator[object]:
+        started_at = time.monotonic()
+        process, spawned = await self._acquire()
+        if stats is not None:
+            stats.mcp_wait_sec += time.monotonic() - started_at
+            if spawned:
+                stats.mcp_spawn_sec += process.spawn_sec
+        healthy = False
+        try:
+            yield process.session
+            healthy = True
+        except asyncio.CancelledError:
+            healthy = True
+            raise
+        finally:
+            await self._release(process, healthy)
+
+    def _is_available(self, process: McpProcess) -> bool:
+        return (
+            process.is_alive
+            and not process.retiring
+            and process.calls + process.active < self.max_calls
+            and process.active < self.calls_per_process
+        )
+
+    async def _acquire(self) -> tuple[McpProcess, bool]:
+        while True:
+            dead: list[McpProcess] = []
+            async with self._condition:
+                while True:
+                    for item in list(self._processes):
+                        if item.active == 0 and (not item.is_alive or item.retiring):
+                            self._processes.remove(item)
+                            dead.append(item)
+                    candidates = [item for item in self._processes if self._is_available(item)]
+                    if candidates:
+                        process = min(candidates, key=lambda item: item.active)
+                        was_idle = process.active == 0
+                        process.active += 1
+                        break
+                    if len(self._processes) + self._starting < self.size:
+                        process = None
+                        self._starting += 1
+                        break
+                    await self._condition.wait()
+            for item in dead:
+                await item.close()
+
+            if process is None:
+                return await self._spawn(), True
+            if (
+                not was_idle
+                or time.monotonic() - process.last_used_at < self.healthcheck_sec
+                or await process.ping()
+            ):
+                return process, False
+            process.retiring = True
+            await self._release(process, healthy=False, count_call=False)
+
+    async def _spawn(self) -> McpProcess:
+        process = McpProcess()
+        try:
+            await process.start()
+        finally:
+            async with self._condition:
+                self._starting -= 1
+                if process.is_alive:
+                    process.active = 1
+                    self._processes.append(process)
+                self._condition.notify_all()
+        return process
+
+    async def _release(self, process: McpProcess, healthy: bool, count_call: bool = True) -> None:
+        async with self._condition:
+            process.active -= 1
+            if count_call:
+                process.calls += 1
+            process.last_used_at = time.monotonic()
+            if not healthy or not process.is_alive or process.calls >= self.max_calls:
+                process.retiring = True
+            should_close = process.retiring and process.active == 0
+            if should_close and process in self._processes:
+                self._processes.remove(process)
+            self._condition.notify_all()
+        if should_close:
+            await process.close()
+
+    async def close(self) -> None:
+        async with self._condition:
+            idle = [item for item in self._processes if item.active == 0]
+            for item in self._processes:
+                item.retiring = True
+            self._processes = [item for item in self._processes if item.active > 0]
+            self._condition.notify_all()
+        for process in idle:
+            await process.close()
+
+
+_POOL: McpPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> McpPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = McpPool()
+        return _POOL
@@ -1,18 +1,303 @@
 from __future__ import annotations
 
+import asyncio
+from collections import OrderedDict
+import dataclasses
+import json
 import os
+import posixpath
+import time
+import uuid
 
-import inspect
-import os
-
-from agents import Agent, Runner
+import anyio
+from agents import Agent, RunConfig, Runner
+from agents.models.interface import Model
 from agents.models.openai_provider import OpenAIProvider
-from mcp.server.fastmcp import FastMCP
+from agents.tool import FunctionTool, default_tool_error_function
+import httpx
+from mcp.server.fastmcp import Context, FastMCP
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from .fake_model import FakeModel, is_fake_model
+from .patches import PatchError, parse_patch
+from .run_context import RunContext, use_run_context
+from .sandbox_paths import resolve_sandbox_root
+from .worktrees import CODEX_WORKTREES, create_worktree, release_worktree
+from .sandbox_tools import (
+    apply_patch,
+    find_files,
+    list_files,
+    make_dir,
+    read_file,
+    read_files,
+    run_cmd,
+    run_git,
+    search,
+    terminate_processes,
+    write_file,
+    write_files,
+)
 
-from .sandbox_tools import list_files, make_dir, read_file, run_cmd, run_git, write_file
+LLM_PROVIDER_CACHE_SIZE = int(os.getenv("LLM_PROVIDER_CACHE_SIZE", "8"))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_KEEPALIVE_SEC = float(os.getenv("LLM_HTTP_KEEPALIVE_SEC", "120"))
+LLM_STREAM_FLUSH_SEC = float(os.getenv("LLM_STREAM_FLUSH_SEC", "0.3"))
+LLM_STREAM_OUTPUT_CHARS = int(os.getenv("LLM_STREAM_OUTPUT_CHARS", "8192"))
+LLM_TOOL_CACHE_BYTES = int(os.getenv("LLM_TOOL_CACHE_BYTES", "8388608"))
+CODEX_CMD_RESERVE_SEC = float(os.getenv("CODEX_CMD_RESERVE_SEC", "15"))
+
+_READ_ONLY_GIT = frozenset(
+    {
+        "blame",
+        "cat-file",
+        "describe",
+        "diff",
+        "grep",
+        "log",
+        "ls-files",
+        "rev-parse",
+        "shortlog",
+        "show",
+        "status",
+    }
+)
+_TOOL_ERROR_PREFIX = default_tool_error_function(None, Exception(""))
 
 server = FastMCP("kb-codex")
 
+_HTTP_CLIENT: httpx.AsyncClient | None = None
+_MODELS: OrderedDict[tuple[str, str, float, int], Model] = OrderedDict()
+_RUNS: dict[str, tuple[anyio.CancelScope, RunContext]] = {}
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=LLM_HTTP_KEEPALIVE_SEC,
+            ),
+        )
+    return _HTTP_CLIENT
+
+
+def _get_model(api_key: str, model: str, timeout: float, max_retries: int) -> Model:
+    key = (api_key, model, timeout, max_retries)
+    cached = _MODELS.get(key)
+    if cached is not None:
+        _MODELS.move_to_end(key)
+        return cached
+    for stale_key in [item for item in _MODELS if item[0] != api_key]:
+        del _MODELS[stale_key]
+    if is_fake_model(model):
+        cached = FakeModel(model)
+    else:
+        client = AsyncOpenAI(
+            api_key=api_key,
+            timeout=timeout,
+            max_retries=max_retries,
+            http_client=_get_http_client(),
+        )
+        cached = OpenAIProvider(openai_client=client).get_model(model)
+    _MODELS[key] = cached
+    while len(_MODELS) > LLM_PROVIDER_CACHE_SIZE:
+        _MODELS.popitem(last=False)
+    return cached
+
+
+class _ProgressStream:
+    def __init__(self, ctx: Context | None) -> None:
+        self._ctx = ctx
+        self._text: list[str] = []
+        self._sent = 0
+        self._flushed_at = time.monotonic()
+        self._output: list[str] = []
+        self._output_size = 0
+        self._output_skipped = 0
+        self._output_timer: asyncio.TimerHandle | None = None
+
+    async def text(self, delta: str) -> None:
+        self._text.append(delta)
+        if time.monotonic() - self._flushed_at >= LLM_STREAM_FLUSH_SEC:
+            await self.flush()
+
+    async def event(self, kind: str, text: str) -> None:
+        await self.flush()
+        await self._send({"kind": kind, "text": text})
+
+    def output(self, text: str) -> None:
+        # Вывод команд приходит из потоков run_cmd через call_soon_threadsafe
+        # и уходит пачками не чаще LLM_STREAM_FLUSH_SEC.
+        if self._output_size + len(text) > LLM_STREAM_OUTPUT_CHARS:
+            self._output_skipped += len(text)
+        else:
+            self._output.append(text)
+            self._output_size += len(text)
+        if self._output_timer is None:
+            self._output_timer = asyncio.get_running_loop().call_later(
+                LLM_STREAM_FLUSH_SEC, lambda: asyncio.ensure_future(self._flush_output())
+            )
+
+    async def _flush_output(self) -> None:
+        if self._output_timer is not None:
+            self._output_timer.cancel()
+            self._output_timer = None
+        if not self._output and not self._output_skipped:
+            return
+        chunk = "".join(self._output)
+        if self._output_skipped:
+            chunk += f"\n[... {self._output_skipped} chars of output skipped ...]\n"
+        self._output.clear()
+        self._output_size = 0
+        self._output_skipped = 0
+        await self._send({"kind": "output", "text": chunk})
+
+    async def flush(self) -> None:
+        await self._flush_output()
+        self._flushed_at = time.monotonic()
+        if not self._text:
+            return
+        chunk = "".join(self._text)
+        self._text.clear()
+        await self._send({"kind": "text", "text": chunk})
+
+    async def _send(self, payload: dict[str, str]) -> None:
+        if self._ctx is None:
+            return
+        self._sent += 1
+        try:
+            await self._ctx.report_progress(
+                self._sent, message=json.dumps(payload, ensure_ascii=False)
+            )
+        except Exception:  # pragma: no cover - потоковая выдача не обязательна
+            self._ctx = None
+
+
+def _scope_path(path: object) -> str:
+    normalized = posixpath.normpath(str(path or "."))
+    return "" if normalized == "." else normalized
+
+
+def _overlaps(left: str, right: str) -> bool:
+    return (
+        not left
+        or not right
+        or left == right
+        or right.startswith(f"{left}/")
+        or left.startswith(f"{right}/")
+    )
+
+
+def _tool_scope(name: str, args: dict[str, object]) -> tuple[bool, tuple[str, ...] | None]:
+    """Читает ли инструмент дерево и какие пути он затрагивает (None — все дерево)."""
+    if name in {"read_file", "list_files", "find_files"}:
+        return True, (_scope_path(args.get("path")),)
+    if name == "read_files":
+        return True, tuple(_scope_path(path) for path in args.get("paths") or ())
+    if name == "search":
+        return True, None
+    if name == "run_git":
+        git_args = args.get("args") or []
+        read_only = (
+            bool(git_args)
+            and git_args[0] in _READ_ONLY_GIT
+            and not any(str(item).startswith("--output") for item in git_args)
+        )
+        return read_only, None
+    if name in {"write_file", "make_dir"}:
+        return False, (_scope_path(args.get("path")),)
+    if name == "write_files":
+        return False, tuple(
+            _scope_path(item.get("path")) for item in args.get("files") or () if isinstance(item, dict)
+        )
+    if name == "apply_patch":
+        try:
+            patches = parse_patch(str(args.get("patch") or ""))
+        except PatchError:
+            return False, ()
+        return False, tuple(
+            _scope_path(path)
+            for patch in patches
+            for path in (patch.old_path, patch.new_path)
+            if path is not None
+        )
+    return False, None
+
+
+class _ToolCache:
+    """Кэш результатов читающих инструментов в пределах одного запуска.
+
+    Запись сбрасывает только результаты, чьи пути пересекаются с записанными;
+    run_cmd и изменяющие команды git сбрасывают весь кэш.
+    """
+
+    def __init__(self, max_bytes: int = LLM_TOOL_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[str, tuple[str, ...] | None]] = OrderedDict()
+        self._size = 0
+        self._generation = 0
+
+    def wrap(self, tool: FunctionTool) -> FunctionTool:
+        if self.max_bytes <= 0:
+            return tool
+        invoke = tool.on_invoke_tool
+
+        async def on_invoke_tool(ctx, input: str):
+            try:
+                args = json.loads(input or "{}")
+            except ValueError:
+                return await invoke(ctx, input)
+            reads, paths = _tool_scope(tool.name, args if isinstance(args, dict) else {})
+            if not reads:
+                self.invalidate(paths)
+                try:
+                    return await invoke(ctx, input)
+                finally:
+                    self.invalidate(paths)
+            key = (tool.name, json.dumps(args, sort_keys=True))
+            cached = self._entries.get(key)
+            if cached is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return cached[0]
+            self.misses += 1
+            # Параллельная запись за время вызова делает результат ненадежным.
+            generation = self._generation
+            result = await invoke(ctx, input)
+            if (
+                generation == self._generation
+                and isinstance(result, str)
+                and not result.startswith(_TOOL_ERROR_PREFIX)
+            ):
+                self._store(key, result, paths)
+            return result
+
+        return dataclasses.replace(tool, on_invoke_tool=on_invoke_tool)
+
+    def _store(self, key: tuple[str, str], result: str, paths: tuple[str, ...] | None) -> None:
+        if len(result) > self.max_bytes:
+            return
+        self._entries[key] = (result, paths)
+        self._size += len(result)
+        while self._size > self.max_bytes:
+            _, (stale, _) = self._entries.popitem(last=False)
+            self._size -= len(stale)
+
+    def invalidate(self, paths: tuple[str, ...] | None) -> None:
+        self._generation += 1
+        if paths is None:
+            self._entries.clear()
+            self._size = 0
+            return
+        for key, (result, scope) in list(self._entries.items()):
+            if scope is None or any(_overlaps(left, right) for left in scope for right in paths):
+                del self._entries[key]
+                self._size -= len(result)
+
 
 @server.tool(
     name="run_codex",
@@ -25,58 +310,146 @@ async def run_codex(
     model: str | None = None,
     task_id: int | None = None,
     status_id: int | None = None,
-) -> str:
+    sandbox_dir: str | None = None,
+    run_id: str | None = None,
+    ctx: Context | None = None,
+) -> dict[str, object]:
     if not prompt:
-        return ""
-    if not api_key:
-        raise ValueError("Не задан API_KEY в настройках.")
+        return {"text": ""}
     if not model:
         raise ValueError("Не задан MODEL в настройках.")
+    if not api_key and not is_fake_model(model):
+        raise ValueError("Не задан API_KEY в настройках.")
     timeout = float(os.getenv("LLM_TIMEOUT_SEC", "120"))
+    # Клиент обрывает весь запуск через LLM_TIMEOUT_SEC, поэтому команды должны
+    # укладываться в остаток этого времени и оставлять агенту запас на ответ.
+    deadline = time.monotonic() + max(0.0, timeout - CODEX_CMD_RESERVE_SEC)
     max_retries = int(os.getenv("LLM_MAX_RETRIES", "4"))
-    provider_kwargs = {"api_key": api_key}
-    provider_params = inspect.signature(OpenAIProvider).parameters
-    if "timeout" in provider_params:
-        provider_kwargs["timeout"] = timeout
-    if "max_retries" in provider_params:
-        provider_kwargs["max_retries"] = max_retries
-    provider = OpenAIProvider(**provider_kwargs)
     sandbox_note = (
-        "Рабочая папка: sandbox. Для файлов используй list_files/read_file/write_file/make_dir. "
+        "Рабочая папка: sandbox. Для файлов используй list_files/read_file/write_file/make_dir, "
+        "несколько файлов читай и записывай за один вызов через read_files/write_files. "
+        "Существующие файлы меняй через apply_patch (unified diff или блоки SEARCH/REPLACE), "
+        "а не перезаписью целиком. "
+        "Для поиска по проекту используй find_files (файлы по шаблону) и search (текст по регулярному выражению). "
         "Для запуска команд используй run_cmd, для коммитов используй run_git."
     )
     combined_instructions = "\n\n".join(
         part for part in [instructions, sandbox_note] if part
     )
-    previous_task_id = os.environ.get("CODEX_TASK_ID")
-    previous_status_id = os.environ.get("CODEX_STATUS_ID")
-    if task_id is not None:
-        os.environ["CODEX_TASK_ID"] = str(task_id)
-    else:
-        os.environ.pop("CODEX_TASK_ID", None)
-    if status_id is not None:
-        os.environ["CODEX_STATUS_ID"] = str(status_id)
-    else:
-        os.environ.pop("CODEX_STATUS_ID", None)
-
-    try:
-        agent = Agent(
-            name="codex",
-            instructions=combined_instructions or None,
-            model=provider.get_model(model),
-            tools=[list_files, make_dir, read_file, run_cmd, run_git, write_file],
-        )
-        result = await Runner.run(agent, prompt)
-    finally:
-        if previous_task_id is not None:
-            os.environ["CODEX_TASK_ID"] = previous_task_id
-        else:
-            os.environ.pop("CODEX_TASK_ID", None)
-        if previous_status_id is not None:
-            os.environ["CODEX_STATUS_ID"] = previous_status_id
-        else:
-            os.environ.pop("CODEX_STATUS_ID", None)
-    return str(result.final_output or "")
+    worktree = None
+    if sandbox_dir is None and task_id is not None and CODEX_WORKTREES:
+        worktree = await anyio.to_thread.run_sync(create_worktree, task_id, run_id or uuid.uuid4().hex)
+    stream = _ProgressStream(ctx)
+    tool_cache = _ToolCache()
+    loop = asyncio.get_running_loop()
+    run_context = RunContext(
+        sandbox_dir=worktree or resolve_sandbox_root(sandbox_dir),
+        task_id=task_id,
+        status_id=status_id,
+        run_id=run_id,
+        on_output=(lambda text: loop.call_soon_threadsafe(stream.output, text)) if ctx else None,
+        deadline=deadline,
+    )
+    completed = False
+    with anyio.CancelScope() as scope:
+        if run_id:
+            _RUNS[run_id] = (scope, run_context)
+        try:
+            with use_run_context(run_context):
+                agent = Agent(
+                    name="codex",
+                    instructions=combined_instructions or None,
+                    model=_get_model(api_key or "", model, timeout, max_retries),
+                    tools=[
+                        tool_cache.wrap(tool)
+                        for tool in (
+                            apply_patch,
+                            find_files,
+                            list_files,
+                            make_dir,
+                            read_file,
+                            read_files,
+                            run_cmd,
+                            run_git,
+                            search,
+                            write_file,
+                            write_files,
+                        )
+                    ],
+                )
+                started_at = time.monotonic()
+                tool_started: dict[str, float] = {}
+                tool_calls = 0
+                tool_sec = 0.0
+                result = Runner.run_streamed(
+                    agent, prompt, run_config=RunConfig(tracing_disabled=is_fake_model(model))
+                )
+                try:
+                    async for event in result.stream_events():
+                        if event.type == "raw_response_event":
+                            if getattr(event.data, "type", None) == "response.output_text.delta":
+                                await stream.text(event.data.delta)
+                        elif event.type == "run_item_stream_event" and event.name == "tool_called":
+                            tool_calls += 1
+                            call_id = getattr(event.item.raw_item, "call_id", None)
+                            if call_id:
+                                tool_started[call_id] = time.monotonic()
+                            tool_name = getattr(event.item.raw_item, "name", None)
+                            if tool_name:
+                                await stream.event("tool", tool_name)
+                        elif event.type == "run_item_stream_event" and event.name == "tool_output":
+                            raw_item = event.item.raw_item
+                            call_id = (
+                                raw_item.get("call_id")
+                                if isinstance(raw_item, dict)
+                                else getattr(raw_item, "call_id", None)
+                            )
+                            if call_id in tool_started:
+                                tool_sec += time.monotonic() - tool_started.pop(call_id)
+                except BaseException:
+                    result.cancel()
+                    raise
+                await stream.flush()
+                completed = True
+        finally:
+            if run_id:
+                _RUNS.pop(run_id, None)
+            terminate_processes(run_context)
+            if worktree is not None:
+                commit_message = f"Task {task_id}: agent run {run_id}" if completed else None
+                with anyio.CancelScope(shield=True):
+                    await anyio.to_thread.run_sync(release_worktree, worktree, commit_message)
+    if scope.cancelled_caught:
+        raise RuntimeError("Run cancelled.")
+    usage = result.context_wrapper.usage
+    return {
+        "text": str(result.final_output or ""),
+        "usage": {
+            "requests": usage.requests,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "total_tokens": usage.total_tokens,
+        },
+        "model_sec": round(max(0.0, time.monotonic() - started_at - tool_sec), 3),
+        "tool_calls": tool_calls,
+        "tool_sec": round(tool_sec, 3),
+        "tool_cache_hits": tool_cache.hits,
+        "tool_cache_misses": tool_cache.misses,
+    }
+
+
+@server.tool(
+    name="cancel_run",
+    description="Cancel a running run_codex call and kill its sandbox processes.",
+)
+async def cancel_run(run_id: str) -> str:
+    entry = _RUNS.get(run_id)
+    if entry is None:
+        return "not found"
+    scope, run_context = entry
+    terminate_processes(run_context)
+    scope.cancel()
+    return "cancelled"
 
 
 def main() -> None:
@@ -0,0 +1,8 @@
+from __future__ import annotations
+
+# Без зависимостей от agents SDK: проверку вызывает и codex.py на стороне Flask.
+FAKE_MODEL_PREFIX = "fake:"
+
+
+def is_fake_model(model: str | None) -> bool:
+    return bool(model) and (model == "fake" or model.startswith(FAKE_MODEL_PREFIX))
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import difflib
+import re
+
+SEARCH_MARKER = "<<<<<<< SEARCH"
+DIVIDER_MARKER = "======="
+REPLACE_MARKER = ">>>>>>> REPLACE"
+CONFLICT_PREVIEW_LINES = 3
+
+_HUNK_RE = re.compile(r"^@@(?: -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))?)? @@")
+
+
+class PatchError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
+class Hunk:
+    header: str
+    old_start: int | None
+    old: list[str] = field(default_factory=list)
+    new: list[str] = field(default_factory=list)
+    # True/False, если в хунке была отметка "\ No newline at end of file".
+    eof_newline: bool | None = None
+    unique: bool = False
+
+
+@dataclass(slots=True)
+class FilePatch:
+    old_path: str | None
+    new_path: str | None
+    hunks: list[Hunk] = field(default_factory=list)
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path or ""
+
+
+@dataclass(slots=True)
+class PatchResult:
+    content: str | None
+    added: int = 0
+    removed: int = 0
+
+
+def parse_patch(text: str) -> list[FilePatch]:
+    """Разбирает unified diff или блоки SEARCH/REPLACE в список правок по файлам."""
+    if any(line.strip() == SEARCH_MARKER for line in text.splitlines()):
+        patches = _parse_search_replace(text)
+    else:
+        patches = _parse_unified(text)
+    if not patches:
+        raise PatchError("Patch contains no file changes.")
+    return patches
+
+
+def _diff_path(raw: str) -> str | None:
+    path = raw.split("\t", 1)[0].strip()
+    if path == "/dev/null":
+        return None
+    if path[:2] in {"a/", "b/"}:
+        path = path[2:]
+    return path
+
+
+def _parse_unified(text: str) -> list[FilePatch]:
+    lines = text.splitlines()
+    patches: list[FilePatch] = []
+    current: FilePatch | None = None
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if line.startswith("--- ") and index + 1 < len(lines) and lines[index + 1].startswith("+++ "):
+            current = FilePatch(_diff_path(line[4:]), _diff_path(lines[index + 1][4:]))
+            if current.old_path is None and current.new_path is None:
+                raise PatchError(f"Invalid file header: {line}")
+            patches.append(current)
+            index += 2
+            continue
+        if not line.startswith("@@"):
+            index += 1
+            continue
+        if current is None:
+            raise PatchError(f"Hunk without file header: {line}")
+        match = _HUNK_RE.match(line)
+        if match is None:
+            raise PatchError(f"Invalid hunk header: {line}")
+        old_start = int(match.group(1)) if match.group(1) is not None else None
+        if old_start is not None and match.group(2) == "0":
+            # "@@ -N,0" вставляет строки после строки N.
+            old_start += 1
+        hunk = Hunk(line, old_start)
+        index += 1
+        last_kind = ""
+        trailing_blank = 0
+        while index < len(lines):
+            body = lines[index]
+            if body.startswith("@@") or body.startswith("diff "):
+                break
+            if body.startswith("--- ") and index + 1 < len(lines) and lines[index + 1].startswith("+++ "):
+                break
+            kind, content = body[:1], body[1:]
+            if kind == "\\":
+                if last_kind in {" ", "+"}:
+                    hunk.eof_newline = False
+                elif last_kind == "-" and hunk.eof_newline is None:
+                    hunk.eof_newline = True
+            elif kind == "-":
+                hunk.old.append(content)
+            elif kind == "+":
+                hunk.new.append(content)
+            elif kind in {" ", ""}:
+                hunk.old.append(content)
+                hunk.new.append(content)
+            else:
+                raise PatchError(f"Invalid line in hunk {hunk.header}: {body}")
+            last_kind = kind or " "
+            trailing_blank = trailing_blank + 1 if not body else 0
+            index += 1
+        # Пустые строки без пробела в конце хунка — хвост ответа модели, а не контекст.
+        del hunk.old[len(hunk.old) - trailing_blank :]
+        del hunk.new[len(hunk.new) - trailing_blank :]
+        current.hunks.append(hunk)
+    return patches
+
+
+def _parse_search_replace(text: str) -> list[FilePatch]:
+    patches: dict[str, FilePatch] = {}
+    path: str | None = None
+    lines = text.splitlines()
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        stripped = line.strip()
+        index += 1
+        if stripped != SEARCH_MARKER:
+            if stripped and not stripped.startswith("```") and stripped != REPLACE_MARKER:
+                path = stripped
+            continue
+        if path is None:
+            raise PatchError("SEARCH block without a file path before it.")
+        search: list[str] = []
+        while index < len(lines) and lines[index].strip() != DIVIDER_MARKER:
+            search.append(lines[index])
+            index += 1
+        replace: list[str] = []
+        index += 1
+        while index < len(lines) and lines[index].strip() != REPLACE_MARKER:
+            replace.append(lines[index])
+            index += 1
+        if index >= len(lines):
+            raise PatchError(f"Unterminated SEARCH/REPLACE block for {path}.")
+        index += 1
+        patch = patches.setdefault(path, FilePatch(path, path))
+        patch.hunks.append(
+            Hunk(f"SEARCH/REPLACE #{len(patch.hunks) + 1}", None, search, replace, unique=True)
+        )
+    return list(patches.values())
+
+
+def _matches(lines: list[str], old: list[str], start: int, loose: bool) -> list[int]:
+    if loose:
+        old = [line.rstrip() for line in old]
+    found = []
+    for position in range(start, len(lines) - len(old) + 1):
+        window = lines[position : position + len(old)]
+        if loose:
+            window = [line.rstrip() for line in window]
+        if window == old:
+            found.append(position)
+    return found
+
+
+def _locate(lines: list[str], hunk: Hunk, cursor: int, expected: int) -> int:
+    for loose in (False, True):
+        found = _matches(lines, hunk.old, 0 if hunk.unique else cursor, loose)
+        if not found:
+            continue
+        if hunk.unique and len(found) > 1:
+            raise PatchError(
+                f"{hunk.header}: search text matches {len(found)} places, add more context."
+            )
+        return min(found, key=lambda position: abs(position - expected))
+    preview = "\n".join(f"  {line}" for line in hunk.old[:CONFLICT_PREVIEW_LINES])
+    raise PatchError(f"{hunk.header}: context not found:\n{preview}")
+
+
+def apply_file_patch(content: str | None, patch: FilePatch) -> PatchResult:
+    """Применяет правки к содержимому файла; None — файла нет или он удаляется."""
+    if patch.new_path is None:
+        if content is None:
+            raise PatchError("file to delete does not exist.")
+        return PatchResult(None, 0, len(content.splitlines()))
+    creating = patch.old_path is None or (
+        content is None and all(hunk.unique and not hunk.old for hunk in patch.hunks)
+    )
+    if creating:
+        if content:
+            raise PatchError("file already exists.")
+        content = ""
+    elif content is None:
+        raise PatchError("file does not exist.")
+    newline = "\r\n" if "\r\n" in content else "\n"
+    eof_newline = content.endswith("\n") or not content
+    lines = content.splitlines()
+    cursor = 0
+    shift = 0
+    added = removed = 0
+    for hunk in patch.hunks:
+        if not hunk.old:
+            if hunk.unique:
+                position = len(lines)
+            else:
+                position = max(0, (hunk.old_start or 1) - 1 + shift)
+                position = min(position, len(lines))
+        else:
+            expected = (hunk.old_start - 1 + shift) if hunk.old_start else cursor
+            position = _locate(lines, hunk, cursor, expected)
+        lines[position : position + len(hunk.old)] = hunk.new
+        shift += len(hunk.new) - len(hunk.old)
+        cursor = position + len(hunk.new)
+        for tag, old_from, old_to, new_from, new_to in difflib.SequenceMatcher(
+            None, hunk.old, hunk.new, autojunk=False
+        ).get_opcodes():
+            if tag != "equal":
+                removed += old_to - old_from
+                added += new_to - new_from
+        if hunk.eof_newline is not None:
+            eof_newline = hunk.eof_newline
+    text = newline.join(lines)
+    if lines and eof_newline:
+        text += newline
+    return PatchResult(text, added, removed)
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import random
+import threading
+import time
+
+import anyio
+
+LLM_RETRY_BACKOFF_SEC = float(os.getenv("LLM_RETRY_BACKOFF_SEC", "2"))
+LLM_RETRY_BACKOFF_MAX_SEC = float(os.getenv("LLM_RETRY_BACKOFF_MAX_SEC", "30"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_SEC = float(os.getenv("LLM_BREAKER_COOLDOWN_SEC", "30"))
+LLM_BREAKER_PROBE_WAIT_SEC = float(os.getenv("LLM_BREAKER_PROBE_WAIT_SEC", "5"))
+
+_RETRYABLE_MARKERS = (
+    "error code: 408",
+    "error code: 409",
+    "error code: 429",
+    "error code: 500",
+    "error code: 502",
+    "error code: 503",
+    "error code: 504",
+    "rate limit",
+    "rate_limit",
+    "overloaded",
+    "timed out",
+    "timeout",
+    "connection error",
+    "connection reset",
+    "temporarily unavailable",
+)
+
+
+class CodexToolError(RuntimeError):
+    pass
+
+
+class CodexSetupError(RuntimeError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, message: str, retry_after_sec: float) -> None:
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (CircuitOpenError, CodexSetupError, ValueError, TypeError)):
+        return False
+    if isinstance(exc, CodexToolError):
+        message = str(exc).lower()
+        return any(marker in message for marker in _RETRYABLE_MARKERS)
+    if isinstance(exc, (TimeoutError, OSError, anyio.BrokenResourceError, anyio.ClosedResourceError)):
+        return True
+    try:
+        from mcp.shared.exceptions import McpError
+    except ModuleNotFoundError:  # pragma: no cover - environment-specific
+        return False
+    return isinstance(exc, McpError)
+
+
+def backoff_delay(attempt: int) -> float:
+    ceiling = min(LLM_RETRY_BACKOFF_MAX_SEC, LLM_RETRY_BACKOFF_SEC * (2**attempt))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        threshold: int = LLM_BREAKER_THRESHOLD,
+        cooldown_sec: float = LLM_BREAKER_COOLDOWN_SEC,
+    ) -> None:
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown_sec = cooldown_sec
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open":
+                remaining = self.cooldown_sec - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError(
+                        f"Провайдер LLM временно недоступен ({self.name}), "
+                        f"повтор через {remaining:.0f} с.",
+                        remaining,
+                    )
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                raise CircuitOpenError(
+                    f"Провайдер LLM проверяется пробным запросом ({self.name}).",
+                    min(self.cooldown_sec, LLM_BREAKER_PROBE_WAIT_SEC),
+                )
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                print(f"[codex] breaker {self.name}: closed")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    print(f"[codex] breaker {self.name}: open")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        with self._lock:
+            self._probe_in_flight = False
+
+
+_BREAKERS: dict[tuple[str, str], CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(model: str, api_key: str) -> CircuitBreaker:
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+    key = (model, key_hash)
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(f"{model}/{key_hash}")
+            _BREAKERS[key] = breaker
+        return breaker
+
+
+def get_breaker_states() -> list[dict[str, object]]:
+    with _BREAKERS_LOCK:
+        breakers = list(_BREAKERS.values())
+    return [
+        {"name": breaker.name, "state": breaker.state, "failures": breaker.failures}
+        for breaker in breakers
+    ]
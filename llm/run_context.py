@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+import subprocess
+from typing import Callable, Iterator
+
+
+@dataclass(slots=True)
+class RunContext:
+    sandbox_dir: Path
+    task_id: int | None = None
+    status_id: int | None = None
+    run_id: str | None = None
+    processes: set[subprocess.Popen] = field(default_factory=set)
+    # Вызывается из потока команды с очередным куском ее вывода.
+    on_output: Callable[[str], None] | None = None
+    # Момент по time.monotonic(), после которого команды запуска уже не успеют завершиться.
+    deadline: float | None = None
+
+    def env(self) -> dict[str, str]:
+        values: dict[str, str] = {"CODEX_SANDBOX_DIR": str(self.sandbox_dir)}
+        if self.task_id is not None:
+            values["CODEX_TASK_ID"] = str(self.task_id)
+        if self.status_id is not None:
+            values["CODEX_STATUS_ID"] = str(self.status_id)
+        return values
+
+
+_RUN_CONTEXT: ContextVar[RunContext | None] = ContextVar("codex_run_context", default=None)
+
+
+def get_run_context() -> RunContext | None:
+    return _RUN_CONTEXT.get()
+
+
+@contextmanager
+def use_run_context(context: RunContext) -> Iterator[RunContext]:
+    token = _RUN_CONTEXT.set(context)
+    try:
+        yield context
+    finally:
+        _RUN_CONTEXT.reset(token)
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Future
+import threading
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+_LOOP: asyncio.AbstractEventLoop | None = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP.is_closed():
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run() -> None:
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            threading.Thread(target=_run, name="llm-runtime", daemon=True).start()
+            ready.wait()
+            _LOOP = loop
+        return _LOOP
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> Future[T]:
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+    if _LOOP is not None and _in_runtime_thread():
+        coro.close()
+        raise RuntimeError("Нельзя блокировать поток llm-runtime ожиданием результата.")
+    return submit(coro).result(timeout)
+
+
+def _in_runtime_thread() -> bool:
+    try:
+        return asyncio.get_running_loop() is _LOOP
+    except RuntimeError:
+        return False
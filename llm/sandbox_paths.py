@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+import subprocess
+
+# Модуль не тянет agents SDK: его импортирует codex.py на стороне Flask.
+_SANDBOX_DIR = Path(
+    os.getenv("CODEX_SANDBOX_DIR", str(Path.cwd() / "sandbox"))
+).resolve()
+WORKTREES_DIRNAME = ".worktrees"
+CMD_LOGS_DIRNAME = ".cmd-logs"
+CODEX_WORKTREES = os.getenv("CODEX_WORKTREES", "1") == "1"
+
+
+def resolve_sandbox_root(path: str | None = None) -> Path:
+    if not path:
+        return _SANDBOX_DIR
+    candidate = Path(path)
+    if candidate.is_absolute():
+        raise ValueError("Absolute paths are not allowed.")
+    resolved = (_SANDBOX_DIR / candidate).resolve()
+    if resolved != _SANDBOX_DIR and _SANDBOX_DIR not in resolved.parents:
+        raise ValueError("Path escapes sandbox.")
+    return resolved
+
+
+def tree_fingerprint(root: Path | None = None) -> str:
+    base = root or _SANDBOX_DIR
+    digest = hashlib.sha256()
+    if not base.is_dir():
+        return digest.hexdigest()
+    for current, dirs, files in os.walk(base):
+        dirs[:] = sorted(item for item in dirs if item not in {".git", WORKTREES_DIRNAME, CMD_LOGS_DIRNAME})
+        for name in sorted(files):
+            path = Path(current) / name
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            relative = path.relative_to(base).as_posix()
+            digest.update(f"{relative}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def task_branch(task_id: int) -> str:
+    return f"task/{task_id}"
+
+
+def _git_output(base: Path, *args: str) -> str | None:
+    result = subprocess.run(
+        ["git", *args],
+        cwd=str(base),
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout if result.returncode == 0 else None
+
+
+def _working_tree_revision(base: Path) -> str:
+    """HEAD плюс список измененных файлов с их размером и mtime.
+
+    git status сверяет файлы по кэшу индекса, поэтому это дешевле обхода
+    всего дерева в tree_fingerprint.
+    """
+    status = _git_output(
+        base,
+        "status",
+        "--porcelain",
+        "-z",
+        "--no-renames",
+        "--untracked-files=all",
+        "--",
+        ".",
+        f":(exclude){WORKTREES_DIRNAME}",
+        f":(exclude){CMD_LOGS_DIRNAME}",
+    )
+    if status is None:
+        return tree_fingerprint(base)
+    digest = hashlib.sha256((_git_output(base, "rev-parse", "--verify", "-q", "HEAD") or "").encode())
+    for entry in filter(None, status.split("\0")):
+        try:
+            stat = (base / entry[3:]).stat()
+            digest.update(f"{entry}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+        except OSError:
+            digest.update(f"{entry}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def sandbox_revision(task_id: int | None = None) -> str:
+    """Версия файлов, которые увидит запуск задачи: коммит ее ветки или состояние базы."""
+    base = resolve_sandbox_root()
+    if not (base / ".git").is_dir():
+        return tree_fingerprint(base)
+    if CODEX_WORKTREES and task_id is not None:
+        for ref in (f"refs/heads/{task_branch(task_id)}", "HEAD"):
+            revision = _git_output(base, "rev-parse", "--verify", "-q", ref)
+            if revision is not None:
+                return revision.strip()
+    return _working_tree_revision(base)
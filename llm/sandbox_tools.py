@@ -1,8 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+from collections import deque
+import codecs
+from dataclasses import dataclass
+import mmap
 import os
 from pathlib import Path
+import re
+import signal
 import subprocess
+import threading
+import time
+from typing import Callable
+
+from .file_index import BINARY_SNIFF_BYTES, FileIndex, get_file_index, glob_match
+from .patches import apply_file_patch, parse_patch
+from .run_context import RunContext, get_run_context
+from .sandbox_paths import _SANDBOX_DIR, CMD_LOGS_DIRNAME
 
 try:
     from agents import function_tool as tool
@@ -17,14 +32,44 @@ except Exception:  # pragma: no cover - fallback for older/newer agents
             raise ImportError("Cannot resolve tool decorator from agents package.")
 
 
-_SANDBOX_DIR = Path(
-    os.getenv("CODEX_SANDBOX_DIR", str(Path.cwd() / "sandbox"))
-).resolve()
+CODEX_READ_MAX_BYTES = int(os.getenv("CODEX_READ_MAX_BYTES", "65536"))
+CODEX_READ_MMAP_BYTES = int(os.getenv("CODEX_READ_MMAP_BYTES", "1048576"))
+CODEX_BATCH_MAX_FILES = int(os.getenv("CODEX_BATCH_MAX_FILES", "50"))
+CODEX_FIND_MAX_RESULTS = int(os.getenv("CODEX_FIND_MAX_RESULTS", "1000"))
+CODEX_SEARCH_MAX_RESULTS = int(os.getenv("CODEX_SEARCH_MAX_RESULTS", "200"))
+SEARCH_LINE_MAX_CHARS = 240
+LINE_SCAN_BYTES = 1 << 20
+# Весь запуск агента ограничен LLM_TIMEOUT_SEC, так что и команды по умолчанию укладываются в него.
+_LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "120"))
+CODEX_CMD_TIMEOUT_SEC = float(os.getenv("CODEX_CMD_TIMEOUT_SEC", str(_LLM_TIMEOUT_SEC / 2)))
+CODEX_CMD_MAX_TIMEOUT_SEC = float(os.getenv("CODEX_CMD_MAX_TIMEOUT_SEC", str(_LLM_TIMEOUT_SEC)))
+CODEX_CMD_OUTPUT_BYTES = int(os.getenv("CODEX_CMD_OUTPUT_BYTES", "16384"))
+CODEX_CMD_LOGS_KEEP = int(os.getenv("CODEX_CMD_LOGS_KEEP", "20"))
+GIT_AUTHOR_NAME = "codex-agent"
+GIT_AUTHOR_EMAIL = "codex-agent@localhost"
+
+_GIT_READY: dict[Path, tuple[int, int] | None] = {}
+_GIT_READY_LOCK = threading.Lock()
+_PATCH_LOCK = threading.Lock()
+
+
+def _sandbox_dir() -> Path:
+    context = get_run_context()
+    return context.sandbox_dir if context else _SANDBOX_DIR
 
 
 def _ensure_sandbox_dir() -> Path:
-    _SANDBOX_DIR.mkdir(parents=True, exist_ok=True)
-    return _SANDBOX_DIR
+    base = _sandbox_dir()
+    base.mkdir(parents=True, exist_ok=True)
+    return base
+
+
+def _command_env() -> dict[str, str]:
+    env = dict(os.environ)
+    context = get_run_context()
+    if context:
+        env.update(context.env())
+    return env
 
 
 def _resolve_path(path: str) -> Path:
@@ -40,53 +85,69 @@ def _resolve_path(path: str) -> Path:
     return resolved
 
 
-def _ensure_git_repo() -> None:
-    base = _ensure_sandbox_dir()
-    if not (base / ".git").exists():
-        subprocess.run(
-            ["git", "init"],
-            cwd=str(base),
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-    _ensure_git_config(base)
+def _file_index() -> FileIndex:
+    return get_file_index(_ensure_sandbox_dir())
+
+
+def _git_marker(base: Path) -> tuple[int, int] | None:
+    try:
+        stat = (base / ".git").stat()
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def ensure_git_repo(base: Path) -> None:
+    """Один раз на корень песочницы делает git init и задает автора коммитов.
+
+    Повторные вызовы сверяют только inode `.git`, поэтому пересоздание
+    репозитория внутри песочницы тоже замечается.
+    """
+    marker = _git_marker(base)
+    if marker is not None and _GIT_READY.get(base) == marker:
+        return
+    with _GIT_READY_LOCK:
+        marker = _git_marker(base)
+        if marker is not None and _GIT_READY.get(base) == marker:
+            return
+        if marker is None:
+            subprocess.run(
+                ["git", "init"],
+                cwd=str(base),
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+        _ensure_git_config(base)
+        _GIT_READY[base] = _git_marker(base)
+
+
+def forget_git_repo(base: Path) -> None:
+    """Забывает проверку корня, который больше не понадобится (снятое рабочее дерево)."""
+    with _GIT_READY_LOCK:
+        _GIT_READY.pop(base, None)
 
 
 def _ensure_git_config(base: Path) -> None:
-    name_result = subprocess.run(
-        ["git", "config", "--get", "user.name"],
-        cwd=str(base),
-        capture_output=True,
-        text=True,
-    )
-    email_result = subprocess.run(
-        ["git", "config", "--get", "user.email"],
+    result = subprocess.run(
+        ["git", "config", "--get-regexp", r"^user\.(name|email)$"],
         cwd=str(base),
         capture_output=True,
         text=True,
     )
-    if name_result.returncode != 0:
-        subprocess.run(
-            ["git", "config", "user.name", "codex-agent"],
-            cwd=str(base),
-            check=False,
-            capture_output=True,
-            text=True,
-        )
-    if email_result.returncode != 0:
-        subprocess.run(
-            ["git", "config", "user.email", "codex-agent@localhost"],
-            cwd=str(base),
-            check=False,
-            capture_output=True,
-            text=True,
-        )
+    configured = {line.split(" ", 1)[0] for line in result.stdout.splitlines()}
+    for key, value in (("user.name", GIT_AUTHOR_NAME), ("user.email", GIT_AUTHOR_EMAIL)):
+        if key not in configured:
+            subprocess.run(
+                ["git", "config", key, value],
+                cwd=str(base),
+                check=False,
+                capture_output=True,
+                text=True,
+            )
 
 
-@tool
-def list_files(path: str = ".") -> str:
-    """List files in the sandbox directory."""
+def _list_files(path: str) -> str:
     target = _resolve_path(path)
     if not target.exists():
         raise ValueError("Path does not exist.")
@@ -100,43 +161,367 @@ def list_files(path: str = ".") -> str:
 
 
 @tool
-def read_file(path: str) -> str:
-    """Read a UTF-8 text file from the sandbox directory."""
+async def list_files(path: str = ".") -> str:
+    """List files in the sandbox directory."""
+    return await asyncio.to_thread(_list_files, path)
+
+
+def _find_files(glob: str, path: str, max_depth: int | None) -> str:
+    target = _resolve_path(path)
+    if not target.is_dir():
+        raise ValueError("path must point to a directory inside the sandbox.")
+    base = _sandbox_dir()
+    start = "" if target == base else target.relative_to(base).as_posix()
+    matches: list[str] = []
+    for relative in _file_index().iter_files(start, max_depth):
+        if glob_match(relative, glob):
+            if len(matches) == CODEX_FIND_MAX_RESULTS:
+                matches.append(f"[stopped after {CODEX_FIND_MAX_RESULTS} files, narrow the glob]")
+                break
+            matches.append(relative)
+    return "\n".join(matches) or "no files found"
+
+
+@tool
+async def find_files(glob: str = "*", path: str = ".", max_depth: int | None = None) -> str:
+    """Recursively find files in the sandbox by glob pattern.
+
+    Args:
+        glob: Pattern matched against the file name, or against the path from the sandbox root when it contains `/` (e.g. `src/**/*.py`).
+        path: Directory to start from, relative to the sandbox.
+        max_depth: How many directory levels to descend; 1 lists only the starting directory.
+    """
+    if max_depth is not None and max_depth < 1:
+        raise ValueError("max_depth must be >= 1.")
+    return await asyncio.to_thread(_find_files, glob, path, max_depth)
+
+
+def _search(pattern: str, glob: str, max_results: int) -> str:
+    try:
+        regex = re.compile(pattern)
+    except re.error as exc:
+        raise ValueError(f"Invalid pattern: {exc}") from exc
+    index = _file_index()
+    matches: list[str] = []
+    for relative in index.iter_files():
+        if not glob_match(relative, glob):
+            continue
+        for number, line in enumerate(index.lines(relative) or (), start=1):
+            if not regex.search(line):
+                continue
+            if len(matches) == max_results:
+                matches.append(f"[stopped after {max_results} matches, narrow the pattern or glob]")
+                return "\n".join(matches)
+            matches.append(f"{relative}:{number}: {line.strip()[:SEARCH_LINE_MAX_CHARS]}")
+    return "\n".join(matches) or "no matches"
+
+
+@tool
+async def search(pattern: str, glob: str = "*", max_results: int | None = None) -> str:
+    """Search text files in the sandbox with a regular expression.
+
+    Returns `path:line: text` for every matching line. Binary and very large files are skipped.
+
+    Args:
+        pattern: Python regular expression searched in each line.
+        glob: Only search files matching this pattern (same rules as find_files).
+        max_results: Maximum number of matching lines to return.
+    """
+    limit = min(max_results or CODEX_SEARCH_MAX_RESULTS, CODEX_SEARCH_MAX_RESULTS)
+    if limit < 1:
+        raise ValueError("max_results must be >= 1.")
+    return await asyncio.to_thread(_search, pattern, glob, limit)
+
+
+def _line_offset(data: bytes | mmap.mmap, line: int) -> int:
+    # Переводы строк считаются блоками через count/split, а не вызовом find на каждую строку.
+    remaining = line - 1
+    position = 0
+    size = len(data)
+    while remaining > 0 and position < size:
+        chunk = data[position : position + LINE_SCAN_BYTES]
+        count = chunk.count(b"\n")
+        if count < remaining:
+            remaining -= count
+            position += len(chunk)
+            continue
+        tail = chunk.split(b"\n", remaining)[-1]
+        return position + len(chunk) - len(tail)
+    return size if remaining > 0 else position
+
+
+def _read_window(
+    target: Path,
+    offset: int,
+    max_bytes: int,
+    start_line: int | None,
+    end_line: int | None,
+) -> str:
+    relative = target.relative_to(_sandbox_dir()).as_posix()
+    with open(target, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size == 0:
+            return ""
+        if size >= CODEX_READ_MMAP_BYTES:
+            data: bytes | mmap.mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = handle.read()
+        try:
+            if b"\0" in data[:BINARY_SNIFF_BYTES]:
+                return f"[binary file {relative}, {size} bytes, not shown]"
+            start = _line_offset(data, start_line) if start_line else min(offset, size)
+            end = max(start, _line_offset(data, end_line + 1) if end_line else size)
+            stop = min(end, start + max_bytes)
+            truncated = stop < end
+            if truncated:
+                newline = data.rfind(b"\n", start, stop)
+                if newline >= start:
+                    stop = newline + 1
+            text = bytes(data[start:stop]).decode("utf-8", errors="replace")
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    if truncated:
+        separator = "" if text.endswith("\n") else "\n"
+        text += (
+            f"{separator}[truncated: bytes {start}-{stop} of {size} shown, "
+            f"continue with offset={stop}]"
+        )
+    elif start > 0:
+        text = f"[bytes {start}-{stop} of {size}]\n{text}"
+    return text
+
+
+def _read_file(
+    path: str,
+    offset: int = 0,
+    max_bytes: int | None = None,
+    start_line: int | None = None,
+    end_line: int | None = None,
+) -> str:
     target = _resolve_path(path)
     if not target.is_file():
         raise ValueError("File does not exist.")
-    return target.read_text(encoding="utf-8")
+    if offset < 0:
+        raise ValueError("offset must be >= 0.")
+    if start_line is not None and start_line < 1:
+        raise ValueError("start_line must be >= 1.")
+    if end_line is not None and end_line < (start_line or 1):
+        raise ValueError("end_line must be >= start_line.")
+    limit = min(max_bytes or CODEX_READ_MAX_BYTES, CODEX_READ_MAX_BYTES)
+    if limit < 1:
+        raise ValueError("max_bytes must be >= 1.")
+    return _read_window(target, offset, limit, start_line, end_line)
 
 
-@tool
-def write_file(path: str, content: str, append: bool = False) -> str:
-    """Write a UTF-8 text file into the sandbox directory."""
+def _write_file(path: str, content: str, append: bool = False) -> str:
     target = _resolve_path(path)
     target.parent.mkdir(parents=True, exist_ok=True)
     mode = "a" if append else "w"
     with open(target, mode, encoding="utf-8") as output_file:
         output_file.write(content)
-    written_path = target.relative_to(_SANDBOX_DIR)
+    written_path = target.relative_to(_sandbox_dir())
+    _file_index().invalidate(written_path.as_posix())
     return f"Wrote {len(content)} bytes to {written_path}"
 
 
 @tool
-def make_dir(path: str) -> str:
-    """Create a directory inside the sandbox."""
+async def read_file(
+    path: str,
+    offset: int = 0,
+    max_bytes: int | None = None,
+    start_line: int | None = None,
+    end_line: int | None = None,
+) -> str:
+    """Read a UTF-8 text file from the sandbox directory.
+
+    Args:
+        path: File path relative to the sandbox.
+        offset: Byte offset to start reading from.
+        max_bytes: Maximum number of bytes to return; longer output is truncated with a marker.
+        start_line: First line to return (1-based); overrides offset.
+        end_line: Last line to return (inclusive).
+    """
+    return await asyncio.to_thread(_read_file, path, offset, max_bytes, start_line, end_line)
+
+
+def _read_files(paths: list[str], max_bytes_each: int | None) -> str:
+    sections = []
+    for path in paths:
+        try:
+            body = _read_file(path, max_bytes=max_bytes_each)
+        except (OSError, ValueError) as exc:
+            body = f"[error: {exc}]"
+        sections.append(f"=== {path} ===\n{body}")
+    return "\n".join(sections)
+
+
+@tool
+async def read_files(paths: list[str], max_bytes_each: int | None = None) -> str:
+    """Read several UTF-8 text files from the sandbox directory in one call.
+
+    Args:
+        paths: File paths relative to the sandbox.
+        max_bytes_each: Maximum number of bytes to return per file.
+    """
+    if len(paths) > CODEX_BATCH_MAX_FILES:
+        raise ValueError(f"At most {CODEX_BATCH_MAX_FILES} files per call.")
+    return await asyncio.to_thread(_read_files, paths, max_bytes_each)
+
+
+@tool
+async def write_file(path: str, content: str, append: bool = False) -> str:
+    """Write a UTF-8 text file into the sandbox directory."""
+    return await asyncio.to_thread(_write_file, path, content, append)
+
+
+@dataclass(slots=True)
+class FileWrite:
+    path: str
+    content: str
+    append: bool = False
+
+
+def _write_files(files: list[FileWrite]) -> str:
+    results = []
+    for item in files:
+        try:
+            results.append(_write_file(item.path, item.content, item.append))
+        except (OSError, ValueError) as exc:
+            results.append(f"Failed {item.path}: {exc}")
+    return "\n".join(results)
+
+
+@tool
+async def write_files(files: list[FileWrite]) -> str:
+    """Write several UTF-8 text files into the sandbox directory in one call.
+
+    Args:
+        files: Files to write; each entry has a path, content and an append flag.
+    """
+    if len(files) > CODEX_BATCH_MAX_FILES:
+        raise ValueError(f"At most {CODEX_BATCH_MAX_FILES} files per call.")
+    return await asyncio.to_thread(_write_files, files)
+
+
+def _stat_key(path: Path) -> tuple[int, int] | None:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _apply_patch(patch: str) -> str:
+    file_patches = parse_patch(patch)
+    base = _sandbox_dir()
+    changes: dict[Path, str | None] = {}
+    originals: dict[Path, tuple[bytes | None, tuple[int, int] | None]] = {}
+    conflicts: list[str] = []
+    summary: list[str] = []
+    hunks = 0
+    with _PATCH_LOCK:
+        for file_patch in file_patches:
+            try:
+                source = _resolve_path(file_patch.old_path or file_patch.new_path or "")
+                target = _resolve_path(file_patch.new_path) if file_patch.new_path else None
+                for path in {source, target} - {None}:
+                    if path not in originals:
+                        key = _stat_key(path)
+                        originals[path] = (path.read_bytes() if key else None, key)
+                if source in changes:
+                    content = changes[source]
+                else:
+                    data = originals[source][0]
+                    content = data.decode("utf-8") if data is not None else None
+                result = apply_file_patch(content, file_patch)
+            except (OSError, ValueError) as exc:
+                conflicts.append(f"{file_patch.path}: {exc}")
+                continue
+            hunks += len(file_patch.hunks)
+            if target is None:
+                changes[source] = None
+                summary.append(f"D {source.relative_to(base)}")
+                continue
+            changes[target] = result.content
+            counts = f"(+{result.added} -{result.removed})"
+            if target != source:
+                changes[source] = None
+                summary.append(f"R {source.relative_to(base)} -> {target.relative_to(base)} {counts}")
+            elif content is None:
+                summary.append(f"A {target.relative_to(base)} {counts}")
+            else:
+                summary.append(f"M {target.relative_to(base)} {counts}")
+        if conflicts:
+            raise RuntimeError("Patch not applied, no files were changed:\n" + "\n".join(conflicts))
+        for path in changes:
+            if _stat_key(path) != originals[path][1]:
+                raise RuntimeError(
+                    f"Patch not applied: {path.relative_to(base)} changed on disk while patching."
+                )
+        written: list[Path] = []
+        try:
+            for path, content in changes.items():
+                if content is None:
+                    path.unlink(missing_ok=True)
+                else:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    temporary = path.with_name(f".{path.name}.patch-{os.getpid()}")
+                    temporary.write_text(content, encoding="utf-8", newline="")
+                    if originals[path][1] is not None:
+                        os.chmod(temporary, path.stat().st_mode)
+                    os.replace(temporary, path)
+                written.append(path)
+        except OSError:
+            for path in written:
+                original = originals[path][0]
+                if original is None:
+                    path.unlink(missing_ok=True)
+                else:
+                    path.write_bytes(original)
+            raise
+        finally:
+            for path in changes:
+                _file_index().invalidate(path.relative_to(base).as_posix())
+    return f"Applied {hunks} hunk(s) to {len(summary)} file(s):\n" + "\n".join(summary)
+
+
+@tool
+async def apply_patch(patch: str) -> str:
+    """Edit sandbox files with a unified diff or SEARCH/REPLACE blocks instead of rewriting them.
+
+    Either format may touch several files. A unified diff uses `--- a/path` / `+++ b/path` headers
+    and `@@` hunks (`/dev/null` creates or deletes a file). A SEARCH/REPLACE block is the file path on
+    its own line, then `<<<<<<< SEARCH`, the exact lines to find, `=======`, the new lines and
+    `>>>>>>> REPLACE`; the search text must match exactly one place, an empty search creates the file
+    or appends to it. The patch is applied all-or-nothing: on any conflict no file is changed and
+    every conflict is reported.
+
+    Args:
+        patch: Unified diff or SEARCH/REPLACE blocks.
+    """
+    return await asyncio.to_thread(_apply_patch, patch)
+
+
+def _make_dir(path: str) -> str:
     target = _resolve_path(path)
     target.mkdir(parents=True, exist_ok=True)
-    return f"Created {target.relative_to(_SANDBOX_DIR)}"
+    created_path = target.relative_to(_sandbox_dir())
+    _file_index().invalidate(created_path.as_posix())
+    return f"Created {created_path}"
 
 
 @tool
-def run_git(args: list[str]) -> str:
-    """Run a git command inside the sandbox directory."""
-    if not isinstance(args, list) or not all(isinstance(item, str) for item in args):
-        raise ValueError("args must be a list of strings.")
-    _ensure_git_repo()
+async def make_dir(path: str) -> str:
+    """Create a directory inside the sandbox."""
+    return await asyncio.to_thread(_make_dir, path)
+
+
+def _run_git(args: list[str]) -> str:
+    ensure_git_repo(_ensure_sandbox_dir())
     result = subprocess.run(
         ["git", *args],
-        cwd=str(_SANDBOX_DIR),
+        cwd=str(_sandbox_dir()),
         capture_output=True,
         text=True,
     )
@@ -147,28 +532,178 @@ def run_git(args: list[str]) -> str:
 
 
 @tool
-def run_cmd(
+async def run_git(args: list[str]) -> str:
+    """Run a git command inside the sandbox directory."""
+    if not isinstance(args, list) or not all(isinstance(item, str) for item in args):
+        raise ValueError("args must be a list of strings.")
+    try:
+        return await asyncio.to_thread(_run_git, args)
+    finally:
+        _file_index().invalidate()
+
+
+def _kill_process_group(process: subprocess.Popen) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def terminate_processes(context: RunContext) -> None:
+    for process in list(context.processes):
+        _kill_process_group(process)
+
+
+class _OutputCapture:
+    """Голова и хвост вывода команды в памяти, полный вывод — в лог-файле."""
+
+    def __init__(self, log_path: Path, on_output: Callable[[str], None] | None) -> None:
+        self.log_path = log_path
+        self.total = 0
+        self._head = bytearray()
+        self._tail: deque[bytes] = deque()
+        self._tail_size = 0
+        self._head_limit = CODEX_CMD_OUTPUT_BYTES // 4
+        self._tail_limit = CODEX_CMD_OUTPUT_BYTES - self._head_limit
+        self._on_output = on_output
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._log = open(log_path, "wb")
+
+    def feed(self, chunk: bytes) -> None:
+        self.total += len(chunk)
+        self._log.write(chunk)
+        if self._on_output is not None:
+            text = self._decoder.decode(chunk)
+            if text:
+                try:
+                    self._on_output(text)
+                except Exception:  # pragma: no cover - потоковая выдача не обязательна
+                    self._on_output = None
+        room = self._head_limit - len(self._head)
+        if room > 0:
+            self._head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self._tail.append(chunk)
+            self._tail_size += len(chunk)
+            while self._tail_size - len(self._tail[0]) >= self._tail_limit:
+                self._tail_size -= len(self._tail.popleft())
+
+    def pump(self, stream) -> None:
+        try:
+            while chunk := stream.read1(65536):
+                self.feed(chunk)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._log.close()
+
+    def text(self) -> str:
+        head = bytes(self._head)
+        tail = b"".join(self._tail)[-self._tail_limit:] if self._tail else b""
+        if self.total <= len(head) + len(tail):
+            return (head + tail).decode("utf-8", errors="replace").strip()
+        # Обрезка идет по границам строк, чтобы не показывать обрывки.
+        head = head[: head.rfind(b"\n") + 1] or head
+        tail = tail[tail.find(b"\n") + 1 :] or tail
+        omitted = self.total - len(head) - len(tail)
+        head_text = head.decode("utf-8", errors="replace")
+        if head_text and not head_text.endswith("\n"):
+            head_text += "\n"
+        tail_text = tail.decode("utf-8", errors="replace")
+        log_name = self.log_path.relative_to(_sandbox_dir()).as_posix()
+        return (
+            f"{head_text}[... {omitted} bytes omitted, full output in {log_name} ...]\n{tail_text}"
+        ).strip()
+
+
+def _new_log_path(base: Path) -> Path:
+    logs = base / CMD_LOGS_DIRNAME
+    logs.mkdir(parents=True, exist_ok=True)
+    ignore = logs / ".gitignore"
+    if not ignore.exists():
+        ignore.write_text("*\n", encoding="utf-8")
+    existing = sorted(logs.glob("cmd-*.log"))
+    for stale in existing[: max(0, len(existing) - CODEX_CMD_LOGS_KEEP + 1)]:
+        stale.unlink(missing_ok=True)
+    return logs / f"cmd-{time.time_ns()}.log"
+
+
+def _run_cmd(args: list[str], target_cwd: Path, timeout_sec: float) -> str:
+    context = get_run_context()
+    capture = _OutputCapture(
+        _new_log_path(_sandbox_dir()), context.on_output if context else None
+    )
+    try:
+        process = subprocess.Popen(
+            args,
+            cwd=str(target_cwd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            env=_command_env(),
+            start_new_session=True,
+        )
+    except OSError:
+        capture.close()
+        capture.log_path.unlink(missing_ok=True)
+        raise
+    if context:
+        context.processes.add(process)
+    reader = threading.Thread(target=capture.pump, args=(process.stdout,), daemon=True)
+    reader.start()
+    try:
+        process.wait(timeout=timeout_sec)
+    except subprocess.TimeoutExpired as exc:
+        _kill_process_group(process)
+        process.wait()
+        reader.join()
+        output = capture.text()
+        raise RuntimeError(
+            f"command timed out after {exc.timeout:.0f} seconds\n{output}".strip()
+        ) from exc
+    finally:
+        if context:
+            context.processes.discard(process)
+        reader.join()
+        process.stdout.close()
+    output = capture.text()
+    if process.returncode != 0:
+        raise RuntimeError(output or f"command exited with {process.returncode}")
+    return output or "ok"
+
+
+@tool
+async def run_cmd(
     args: list[str],
     cwd: str | None = None,
     timeout_sec: float | None = None,
 ) -> str:
-    """Run a command inside the sandbox directory."""
+    """Run a command inside the sandbox directory.
+
+    Long output is cut to its head and tail; the full log is saved in the sandbox.
+
+    Args:
+        args: Command and its arguments.
+        cwd: Working directory relative to the sandbox.
+        timeout_sec: Seconds before the command is killed; defaults to a server limit.
+    """
     if not isinstance(args, list) or not all(isinstance(item, str) for item in args):
         raise ValueError("args must be a list of strings.")
     target_cwd = _resolve_path(cwd or ".")
     if not target_cwd.is_dir():
         raise ValueError("cwd must point to a directory inside the sandbox.")
+    if timeout_sec is not None and timeout_sec <= 0:
+        raise ValueError("timeout_sec must be > 0.")
+    timeout_sec = min(timeout_sec or CODEX_CMD_TIMEOUT_SEC, CODEX_CMD_MAX_TIMEOUT_SEC)
+    context = get_run_context()
+    if context and context.deadline is not None:
+        remaining = context.deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError("Run time limit is almost reached; finish without running more commands.")
+        timeout_sec = min(timeout_sec, remaining)
     try:
-        result = subprocess.run(
-            args,
-            cwd=str(target_cwd),
-            capture_output=True,
-            text=True,
-            timeout=timeout_sec,
-        )
-    except subprocess.TimeoutExpired as exc:
-        raise RuntimeError(f"command timed out after {exc.timeout} seconds") from exc
-    output = (result.stdout + result.stderr).strip()
-    if result.returncode != 0:
-        raise RuntimeError(output or f"command exited with {result.returncode}")
-    return output or "ok"
+        return await asyncio.to_thread(_run_cmd, args, target_cwd, timeout_sec)
+    finally:
+        _file_index().invalidate()
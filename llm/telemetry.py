@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class RunStats:
+    retries: int = 0
+    cache_hit: bool = False
+    mcp_wait_sec: float = 0.0
+    mcp_spawn_sec: float = 0.0
+    model_sec: float = 0.0
+    tool_calls: int = 0
+    tool_sec: float = 0.0
+    tool_cache_hits: int = 0
+    tool_cache_misses: int = 0
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+
+    def add_tool_result(self, payload: dict[str, object]) -> None:
+        usage = payload.get("usage")
+        if isinstance(usage, dict):
+            self.requests += int(usage.get("requests") or 0)
+            self.input_tokens += int(usage.get("input_tokens") or 0)
+            self.output_tokens += int(usage.get("output_tokens") or 0)
+            self.total_tokens += int(usage.get("total_tokens") or 0)
+        self.model_sec += float(payload.get("model_sec") or 0.0)
+        self.tool_calls += int(payload.get("tool_calls") or 0)
+        self.tool_sec += float(payload.get("tool_sec") or 0.0)
+        self.tool_cache_hits += int(payload.get("tool_cache_hits") or 0)
+        self.tool_cache_misses += int(payload.get("tool_cache_misses") or 0)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import time
+from typing import Iterator
+
+from .file_index import drop_file_index
+from .sandbox_paths import (
+    CODEX_WORKTREES,
+    WORKTREES_DIRNAME,
+    resolve_sandbox_root,
+    task_branch,
+)
+from .sandbox_tools import ensure_git_repo, forget_git_repo
+
+CODEX_WORKTREE_WAIT_SEC = float(os.getenv("CODEX_WORKTREE_WAIT_SEC", "30"))
+WORKTREE_POLL_SEC = 0.2
+
+
+def _git(base: Path, *args: str, check: bool = True) -> subprocess.CompletedProcess[str]:
+    result = subprocess.run(
+        ["git", *args],
+        cwd=str(base),
+        capture_output=True,
+        text=True,
+    )
+    if check and result.returncode != 0:
+        output = (result.stdout + result.stderr).strip()
+        raise RuntimeError(output or f"git {args[0]} exited with {result.returncode}")
+    return result
+
+
+@contextmanager
+def _locked(base: Path) -> Iterator[None]:
+    # Базовый репозиторий делят все процессы MCP, поэтому блокируется сам каталог.
+    fd = os.open(base, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _prepare_base_repo(base: Path) -> None:
+    ensure_git_repo(base)
+    exclude = base / ".git" / "info" / "exclude"
+    exclude.parent.mkdir(parents=True, exist_ok=True)
+    patterns = exclude.read_text(encoding="utf-8").splitlines() if exclude.exists() else []
+    if f"/{WORKTREES_DIRNAME}/" not in patterns:
+        with open(exclude, "a", encoding="utf-8") as handle:
+            handle.write(f"/{WORKTREES_DIRNAME}/\n")
+    if _git(base, "rev-parse", "--verify", "-q", "HEAD", check=False).returncode != 0:
+        _git(base, "add", "-A")
+        _git(base, "commit", "-q", "--allow-empty", "-m", "Initial sandbox state")
+
+
+def _branch_worktrees(base: Path, branch: str) -> list[Path]:
+    paths: list[Path] = []
+    current: Path | None = None
+    for line in _git(base, "worktree", "list", "--porcelain").stdout.splitlines():
+        if line.startswith("worktree "):
+            current = Path(line[len("worktree ") :])
+        elif line == f"branch refs/heads/{branch}" and current is not None:
+            paths.append(current)
+    return paths
+
+
+def create_worktree(task_id: int, run_id: str, base: Path | None = None) -> Path:
+    """Создает рабочее дерево запуска на ветке task/<id> от HEAD базового репозитория.
+
+    Ветку нельзя выписать в два дерева сразу, поэтому сначала дожидаемся, пока
+    предыдущий запуск задачи (например, отмененный) закоммитит и снимет свое дерево.
+    """
+    base = base or resolve_sandbox_root()
+    path = base / WORKTREES_DIRNAME / f"task-{task_id}-{run_id}"
+    branch = task_branch(task_id)
+    base.mkdir(parents=True, exist_ok=True)
+    deadline = time.monotonic() + CODEX_WORKTREE_WAIT_SEC
+    while True:
+        with _locked(base):
+            _prepare_base_repo(base)
+            _git(base, "worktree", "prune")
+            busy = _branch_worktrees(base, branch)
+            if not busy or time.monotonic() >= deadline:
+                # Дерево, которое так и не освободили (упавший процесс), снимается принудительно.
+                for stale in busy:
+                    _git(base, "worktree", "remove", "--force", str(stale), check=False)
+                    shutil.rmtree(stale, ignore_errors=True)
+                _git(base, "worktree", "prune")
+                if _git(base, "rev-parse", "--verify", "-q", f"refs/heads/{branch}", check=False).returncode == 0:
+                    _git(base, "worktree", "add", "-q", str(path), branch)
+                else:
+                    _git(base, "worktree", "add", "-q", "-b", branch, str(path), "HEAD")
+                return path
+        time.sleep(WORKTREE_POLL_SEC)
+
+
+def release_worktree(path: Path, commit_message: str | None = None, base: Path | None = None) -> None:
+    """Коммитит изменения запуска в ветку задачи (если передан commit_message) и удаляет дерево."""
+    base = base or resolve_sandbox_root()
+    with _locked(base):
+        try:
+            if commit_message and path.is_dir() and _git(path, "status", "--porcelain").stdout.strip():
+                _git(path, "add", "-A")
+                _git(path, "commit", "-q", "-m", commit_message)
+        finally:
+            _git(base, "worktree", "remove", "--force", str(path), check=False)
+            shutil.rmtree(path, ignore_errors=True)
+            _git(base, "worktree", "prune", check=False)
+    drop_file_index(path)
+    forget_git_repo(path)
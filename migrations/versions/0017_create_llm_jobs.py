@@ -0,0 +1,47 @@
+"""create llm jobs
+
+Revision ID: 0017_create_llm_jobs
+Revises: 0016_rename_parameters_to_settings
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0017_create_llm_jobs"
+down_revision = "0016_rename_parameters_to_settings"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm_jobs",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("task_id", sa.Integer(), sa.ForeignKey("tasks.id"), nullable=False),
+        sa.Column("status_id", sa.Integer(), nullable=True),
+        sa.Column("project_id", sa.Integer(), nullable=True),
+        sa.Column("agent_id", sa.Integer(), nullable=True),
+        sa.Column("priority", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("state", sa.String(length=20), nullable=False, server_default="pending"),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("max_attempts", sa.Integer(), nullable=False, server_default="1"),
+        sa.Column("lease_owner", sa.String(length=200), nullable=True),
+        sa.Column("lease_expires_at", sa.DateTime(), nullable=True),
+        sa.Column("available_at", sa.DateTime(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("started_at", sa.DateTime(), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.Column("error", sa.Text(), nullable=True),
+    )
+    op.create_index("ix_llm_jobs_task_id", "llm_jobs", ["task_id"])
+    op.create_index("ix_llm_jobs_state_priority", "llm_jobs", ["state", "priority", "id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_llm_jobs_state_priority", table_name="llm_jobs")
+    op.drop_index("ix_llm_jobs_task_id", table_name="llm_jobs")
+    op.drop_table("llm_jobs")
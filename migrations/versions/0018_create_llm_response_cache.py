@@ -0,0 +1,48 @@
+"""create llm response cache
+
+Revision ID: 0018_create_llm_response_cache
+Revises: 0017_create_llm_jobs
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0018_create_llm_response_cache"
+down_revision = "0017_create_llm_jobs"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm_response_cache",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("key", sa.String(length=64), nullable=False, unique=True),
+        sa.Column("response", sa.Text(), nullable=False),
+        sa.Column("hits", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("last_used_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index(
+        "ix_llm_response_cache_last_used_at", "llm_response_cache", ["last_used_at"]
+    )
+    with op.batch_alter_table("agents") as batch:
+        batch.add_column(
+            sa.Column(
+                "use_response_cache",
+                sa.Boolean(),
+                nullable=False,
+                server_default=sa.true(),
+            )
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("agents") as batch:
+        batch.drop_column("use_response_cache")
+    op.drop_index("ix_llm_response_cache_last_used_at", table_name="llm_response_cache")
+    op.drop_table("llm_response_cache")
@@ -0,0 +1,34 @@
+"""add llm job cancel flag
+
+Revision ID: 0019_add_llm_job_cancel
+Revises: 0018_create_llm_response_cache
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0019_add_llm_job_cancel"
+down_revision = "0018_create_llm_response_cache"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("llm_jobs") as batch:
+        batch.add_column(
+            sa.Column(
+                "cancel_requested",
+                sa.Boolean(),
+                nullable=False,
+                server_default=sa.false(),
+            )
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("llm_jobs") as batch:
+        batch.drop_column("cancel_requested")
@@ -0,0 +1,31 @@
+"""add instruction versions
+
+Revision ID: 0020_add_instruction_versions
+Revises: 0019_add_llm_job_cancel
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0020_add_instruction_versions"
+down_revision = "0019_add_llm_job_cancel"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for table in ("roles", "agents", "settings"):
+        with op.batch_alter_table(table) as batch:
+            batch.add_column(
+                sa.Column("version", sa.Integer(), nullable=False, server_default="1")
+            )
+
+
+def downgrade() -> None:
+    for table in ("settings", "agents", "roles"):
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column("version")
@@ -0,0 +1,54 @@
+"""create llm runs
+
+Revision ID: 0022_create_llm_runs
+Revises: 0021_create_task_summaries
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0022_create_llm_runs"
+down_revision = "0021_create_task_summaries"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm_runs",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("task_id", sa.Integer(), nullable=False),
+        sa.Column("job_id", sa.Integer(), nullable=True),
+        sa.Column("agent_id", sa.Integer(), nullable=True),
+        sa.Column("project_id", sa.Integer(), nullable=True),
+        sa.Column("model", sa.String(length=200), nullable=True),
+        sa.Column("outcome", sa.String(length=20), nullable=False),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("cache_hit", sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column("retries", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("queue_wait_sec", sa.Float(), nullable=True),
+        sa.Column("mcp_wait_sec", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("mcp_spawn_sec", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("latency_sec", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("model_sec", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("tool_calls", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("tool_sec", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("requests", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("input_tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("output_tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("total_tokens", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("started_at", sa.DateTime(), nullable=False),
+        sa.Column("finished_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_llm_runs_task_id", "llm_runs", ["task_id"])
+    op.create_index("ix_llm_runs_started_at", "llm_runs", ["started_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_llm_runs_started_at", table_name="llm_runs")
+    op.drop_index("ix_llm_runs_task_id", table_name="llm_runs")
+    op.drop_table("llm_runs")
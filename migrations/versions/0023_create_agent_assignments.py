@@ -0,0 +1,76 @@
+"""create agent assignments
+
+Revision ID: 0023_create_agent_assignments
+Revises: 0022_create_llm_runs
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0023_create_agent_assignments"
+down_revision = "0022_create_llm_runs"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    assignments = op.create_table(
+        "agent_assignments",
+        sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column("agent_id", sa.Integer(), sa.ForeignKey("agents.id"), nullable=False),
+        sa.Column("task_id", sa.Integer(), sa.ForeignKey("tasks.id"), nullable=False, unique=True),
+        sa.Column("assigned_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_agent_assignments_agent_id", "agent_assignments", ["agent_id"])
+
+    connection = op.get_bind()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = connection.execute(
+        sa.text("SELECT id, current_task_id FROM agents WHERE current_task_id IS NOT NULL")
+    ).all()
+    seen_task_ids: set[int] = set()
+    values = []
+    for agent_id, task_id in rows:
+        if task_id in seen_task_ids:
+            continue
+        seen_task_ids.add(task_id)
+        values.append({"agent_id": agent_id, "task_id": task_id, "assigned_at": now})
+    if values:
+        op.bulk_insert(assignments, values)
+
+    with op.batch_alter_table("agents") as batch:
+        batch.add_column(
+            sa.Column("max_concurrency", sa.Integer(), nullable=False, server_default="1")
+        )
+        batch.drop_constraint("fk_agents_current_task_id_tasks", type_="foreignkey")
+        batch.drop_column("current_task_id")
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("agents") as batch:
+        batch.add_column(sa.Column("current_task_id", sa.Integer(), nullable=True))
+        batch.create_foreign_key(
+            "fk_agents_current_task_id_tasks",
+            "tasks",
+            ["current_task_id"],
+            ["id"],
+        )
+        batch.drop_column("max_concurrency")
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT agent_id, MIN(task_id) FROM agent_assignments GROUP BY agent_id")
+    ).all()
+    for agent_id, task_id in rows:
+        connection.execute(
+            sa.text("UPDATE agents SET current_task_id = :task_id WHERE id = :agent_id"),
+            {"task_id": task_id, "agent_id": agent_id},
+        )
+    op.drop_index("ix_agent_assignments_agent_id", table_name="agent_assignments")
+    op.drop_table("agent_assignments")
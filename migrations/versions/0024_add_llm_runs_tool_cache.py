@@ -0,0 +1,33 @@
+"""add tool cache counters to llm runs
+
+Revision ID: 0024_add_llm_runs_tool_cache
+Revises: 0023_create_agent_assignments
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0024_add_llm_runs_tool_cache"
+down_revision = "0023_create_agent_assignments"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("llm_runs") as batch:
+        batch.add_column(
+            sa.Column("tool_cache_hits", sa.Integer(), nullable=False, server_default="0")
+        )
+        batch.add_column(
+            sa.Column("tool_cache_misses", sa.Integer(), nullable=False, server_default="0")
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("llm_runs") as batch:
+        batch.drop_column("tool_cache_misses")
+        batch.drop_column("tool_cache_hits")
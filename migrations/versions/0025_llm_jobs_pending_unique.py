@@ -0,0 +1,45 @@
+"""unique pending llm job per task
+
+Revision ID: 0025_llm_jobs_pending_unique
+Revises: 0024_add_llm_runs_tool_cache
+Create Date: 2024-10-02 00:00:00.000000
+
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0025_llm_jobs_pending_unique"
+down_revision = "0024_add_llm_runs_tool_cache"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    connection = op.get_bind()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    connection.execute(
+        sa.text(
+            "UPDATE llm_jobs SET state = 'cancelled', finished_at = :now, "
+            "error = 'Задача перемещена до запуска.' "
+            "WHERE state = 'pending' AND id NOT IN ("
+            "SELECT MAX(id) FROM llm_jobs WHERE state = 'pending' GROUP BY task_id)"
+        ),
+        {"now": now},
+    )
+    op.create_index(
+        "uq_llm_jobs_pending_task_id",
+        "llm_jobs",
+        ["task_id"],
+        unique=True,
+        sqlite_where=sa.text("state = 'pending'"),
+        postgresql_where=sa.text("state = 'pending'"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_llm_jobs_pending_task_id", table_name="llm_jobs")
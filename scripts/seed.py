@@ -13,11 +13,12 @@ if APP_ROOT not in sys.path:
     sys.path.insert(0, APP_ROOT)
 
 from db import SessionLocal
-from models import Agent, Column, Message, Project, Role, Status, Task
+from models import Agent, AgentAssignment, Column, Message, Project, Role, Status, Task
 
 
 def clear_data(session) -> None:
     session.execute(sa.delete(Message))
+    session.execute(sa.delete(AgentAssignment))
     session.execute(sa.delete(Task))
     session.execute(sa.delete(Agent))
     session.execute(sa.delete(Column))